@@ -28,6 +28,65 @@ Description:
        python 03_notebook_exporter.py "01_eda.ipynb" "02_model.ipynb"
        python 03_notebook_exporter.py "1. EDA.ipynb" Miscellaneous.ipynb
 
+   Export several notebooks in parallel (0 = one worker per CPU core):
+       python 03_nb_exporter.py --jobs 4 "01_eda.ipynb" "02_model.ipynb"
+
+   Notebooks unchanged since their last export are skipped (see .nb_export_cache.json), to re-export anyway:
+       python 03_nb_exporter.py --force "01_eda.ipynb"
+
+   Site mode, pages in ../site sharing one cached copy of plotly.js and the CSS/JS (figure pages can join too):
+       python 03_nb_exporter.py --site ../site "01_eda.ipynb" "02_model.ipynb" ../outputs/correlation_heatmap.html
+
+   Write plot images to images/<hash>.png next to the HTML (lazy-loaded) instead of embedding them as base64:
+       python 03_nb_exporter.py --extract-images "01_eda.ipynb"
+
+   Log how long each export phase took (read, parse, render, inject, write) as JSON lines (- = stderr):
+       python 03_nb_exporter.py --log-json export_log.jsonl "01_eda.ipynb" "02_model.ipynb"
+
+   Draw Plotly figures only when they are scrolled near (and free the ones far away) for a fast first paint:
+       python 03_nb_exporter.py --lazy-plotly --purge-offscreen-plots "02_model.ipynb"
+
+   Embed the smallest partial plotly.js bundle covering the figures' trace types (e.g. cartesian for bar/box/heatmap)
+   instead of the full 4.5 MB one, from a directory of plotly.js dist files of the same version:
+       python 03_nb_exporter.py --plotly-bundles ../vendor/plotly "01_eda.ipynb"
+
+   Site mode with each Plotly figure's data in its own assets/figure-<hash>.json, fetched when scrolled near
+   (serve the site over HTTP, browsers don't fetch files from file:// pages):
+       python 03_nb_exporter.py --site ../site --external-figures "02_model.ipynb"
+
+   Keep one copy of the Plotly layout template per page instead of one per figure:
+       python 03_nb_exporter.py --share-plotly-templates "01_eda.ipynb" "02_model.ipynb"
+
+   Write Plotly arrays of 100+ numbers (heatmap z, ROC curves, ...) as base64 typed arrays, optionally as 4-byte floats:
+       python 03_nb_exporter.py --typed-arrays --float32 "02_model.ipynb"
+
+   Downsample scatter/line traces of more than 5000 points (LTTB for lines, min/max per x bin for markers):
+       python 03_nb_exporter.py --downsample-plotly --downsample-max-points 5000 "01_eda.ipynb"
+
+   Open big notebooks fast: h3 and deeper sections, and any section over 500 KB, start collapsed and are built on first expand:
+       python 03_nb_exporter.py --collapse-level 3 --collapse-min-kb 500 "02_model.ipynb"
+
+   Show DataFrames of 50+ rows as a scrollable, sortable view built from JSON instead of thousands of <tr> tags:
+       python 03_nb_exporter.py --virtualize-tables --virtual-table-min-rows 50 "01_eda.ipynb"
+
+   One self-contained, self-decompressing file small enough to attach to an email (opens in any recent browser):
+       python 03_nb_exporter.py --compact-single-file "02_model.ipynb"
+
+   Write .html.gz (and .html.br with the brotli package) next to every page and site asset, for static servers:
+       python 03_nb_exporter.py --precompress --site ../site "01_eda.ipynb" "02_model.ipynb"
+
+   Show which cells make a page heavy, and fail (e.g. in "make export") when a page exceeds its size budgets:
+       python 03_nb_exporter.py --report --max-total-mb 10 --max-cell-mb 2 --max-dom-nodes 50000 "02_model.ipynb"
+
+   Re-export notebooks whenever they are saved (a directory watches every notebook in it), stop with Ctrl+C:
+       python 03_nb_exporter.py --watch --site ../site ../notebooks
+
+   Preview notebooks in the browser without writing files, http://127.0.0.1:8000/01_eda.html renders on first visit:
+       python 03_nb_exporter.py serve ../notebooks --port 8000
+
+   Add the current watermark and numbering to HTML files exported earlier, streamed with bounded memory:
+       python 03_nb_exporter.py postprocess ../notebooks/02_model_20250926_001951.html
+
 Makefile example:
     # Pass NOTEBOOKS="file1.ipynb file2.ipynb" to override
     NOTEBOOKS ?= "01_eda.ipynb" "02_model.ipynb"
@@ -40,32 +99,106 @@ Tip:
 
 """
 
+import argparse # For parsing command line options
+import base64 # For decoding images embedded as data: URIs
+import collections # For counting repeated warning lines
+import concurrent.futures # For exporting notebooks in parallel worker processes
+import contextlib # For the timing span context manager
+import functools # For caching the in-process exporter
+import gzip # For gzip-encoded responses of the preview server and .gz sidecar files
+import hashlib # For content hashes in the export cache
+import html as html_lib # For unescaping DataFrame cell text (html is used as a variable name throughout)
+import http.server # For the local preview server (serve subcommand)
+import json # For the export cache manifest
+import os # For CPU count and exclusive file creation
+import struct # For reading image dimensions from PNG/GIF/JPEG headers
 import pathlib # For handling file system paths
-import subprocess # For running shell commands (nbconvert)
+import re # For finding <style>/<script> blocks in the rendered HTML
+import select # For waiting on inotify events with a timeout (watch mode)
+import subprocess # For running shell commands (nbconvert fallback)
+import threading # For serializing renders in the preview server
+import sys # For writing the JSON export log to stderr
+import time # For timing export phases
 import urllib.parse # For safely embedding SVG in HTML
 from datetime import datetime # For timestamped filenames
 
-def export_notebook(notebook_name):
-    
-    # https://docs.python.org/3/library/pathlib.html
+# Jinja template extending nbconvert's own index.html.j2: everything stays the same, except that the
+# CSS + JS injection passed in resources["html_injection"] is rendered at the end of <head>
+# https://nbconvert.readthedocs.io/en/latest/customizing.html#template-structure
+INJECTION_TEMPLATE_NAME = "nb_export_index.html.j2"
+INJECTION_TEMPLATE = """{%- extends 'index.html.j2' -%}
+{%- block html_head -%}
+{{ super() }}
+{{ resources.html_injection }}
+{%- endblock html_head -%}
+"""
 
-    # Convert notebook to HTML
-    notebook = pathlib.Path(notebook_name).resolve() # Creates a path object, resolve() gets absolute path
+# ===== Stream output coalescing =====
+# Training cells print hundreds of tiny stdout/stderr outputs (tqdm redraws, Optuna trial logs, LightGBM warnings),
+# each rendered as its own output block. nbconvert's CoalesceStreamsPreprocessor merges adjacent outputs of the same
+# stream (so interleaved stdout/stderr lines keep their order) and keeps only the text after a line's last carriage
+# return (a progress bar collapses to its final state). On top of that, one copy of each repeated warning line is kept
+# with a count.
+# Lines that are deduplicated, e.g. "[LightGBM] [Warning] ..." or "UserWarning: ..."
+STREAM_WARNING_RE = re.compile(r"warn", re.I)
 
-    # Timestamp for unique filenames
-    timestamp_str = datetime.now().strftime("%Y%m%d_%H%M%S")
+def collapse_repeated_warnings(text):
+    # Keep the first occurrence of each repeated warning line, annotated with how often it appeared
+    lines = text.split("\n")
+    counts = collections.Counter(line for line in lines if STREAM_WARNING_RE.search(line))
+    kept, seen = [], set()
+    for line in lines:
+        if counts.get(line, 0) > 1:
+            if line in seen: # Later duplicates are dropped
+                continue
+            seen.add(line)
+            line = f"{line}  [repeated {counts[line]} times]"
+        kept.append(line)
+    return "\n".join(kept)
 
-    # Create a new filename with timestamp (e.g. notebook_YYYYMMDD_HHMMSS.html)
-    html_file = notebook.with_name(f'{notebook.stem}_{timestamp_str}.html')
+def coalesce_streams_preprocessor(nb, resources):
+    # nbconvert preprocessor (plain function form), active when resources["coalesce_streams"] is set
+    # https://nbconvert.readthedocs.io/en/latest/api/exporters.html#nbconvert.exporters.Exporter.register_preprocessor
+    if not resources.get("coalesce_streams"):
+        return nb, resources
+    # Only the in-process exporter runs preprocessors, so nbconvert is installed whenever this is reached
+    # https://nbconvert.readthedocs.io/en/latest/api/preprocessors.html#nbconvert.preprocessors.CoalesceStreamsPreprocessor
+    from nbconvert.preprocessors import CoalesceStreamsPreprocessor
+    nb, resources = CoalesceStreamsPreprocessor().preprocess(nb, resources)
+    for cell in nb.cells:
+        for output in cell.get("outputs", []):
+            if output.get("output_type") == "stream":
+                output.text = collapse_repeated_warnings(output.text)
+    return nb, resources
 
-    # Run nbconvert with explicit output filename
-    # https://docs.python.org/3/library/subprocess.html#subprocess.run
-    subprocess.run(
-        ["jupyter", "nbconvert", "--to", "html", str(notebook), "--output", html_file.name],
-        cwd = notebook.parent, # Run from the same directory as the notebook
-        check = True, # Raise CalledProcessError if command fails (non-zero exit code)
-        capture_output = True, text = True # Capture logs in readable text format
+
+@functools.lru_cache(maxsize = None) # Build the exporter only once per process, later calls return the same object
+def get_html_exporter():
+    # In-process nbconvert engine: importing Jupyter/nbconvert and compiling the Jinja template
+    # happens once here instead of once per notebook in a fresh "jupyter nbconvert" process
+    # https://nbconvert.readthedocs.io/en/latest/nbconvert_library.html
+    try:
+        from jinja2 import DictLoader # nbconvert depends on Jinja2, so it is available whenever nbconvert is
+        from nbconvert import HTMLExporter # Same exporter class "jupyter nbconvert --to html" uses
+    except ImportError: # nbconvert not importable from this interpreter
+        return None # Caller falls back to the "jupyter nbconvert" subprocess
+    # Default "lab" template, same output as the command line tool, with the injection done at render time
+    # (extra_loaders are searched first, so our template is found by name and extends the real lab template)
+    exporter = HTMLExporter(
+        extra_loaders = [DictLoader({INJECTION_TEMPLATE_NAME: INJECTION_TEMPLATE})],
+        template_file = INJECTION_TEMPLATE_NAME
     )
+    # Our preprocessors run on every export and check resources for their per-export options
+    exporter.register_preprocessor(coalesce_streams_preprocessor, enabled = True)
+    return exporter
+
+# Marks where the injection starts in the <head>; stays in the page when site mode moves the CSS/JS to asset files
+INJECTION_MARKER = "<!-- ===== Exporter injection ===== -->"
+
+@functools.lru_cache(maxsize = None) # The injection never changes between exports, so build it once
+def build_html_injection():
+    # CSS + JS injected before </head>: watermark, line numbers, collapsible headings, floating buttons
+    # (the per-export timestamp footer is added separately by build_timestamp_footer())
 
     # Scalable Vector Graphics(SVG) watermark design (gray, rotated text)
     # https://www.w3.org/TR/SVG2/struct.html#SVGElement
@@ -88,15 +221,11 @@ def export_notebook(notebook_name):
     # Make the SVG displayable in the browser by embedding it safely in a link
     svg = "data:image/svg+xml;utf8," + urllib.parse.quote(svg_code)
 
-    # CSS + JS injection (kept unchanged, plus footer timestamp added at the end)
-    timestamp_footer = f'''
-                <!-- ===== Timestamp Footer ===== -->
-                <footer style="position: fixed; bottom: 5px; right: 10px; font-size: 12px; color: gray; opacity: 0.7;">
-                  Exported on {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
-                </footer>
-                '''
-
-    html_injection = f'''<style>
+    # CSS + JS injection: watermark, code line number and heading styles, one delegated click listener that collapses
+    # sections and builds deferred ones when first expanded, toggle functions and floating buttons. Line numbers, heading
+    # numbers and section containers are not built here in the browser but at export time (number_headings() etc.)
+    html_injection = f'''{INJECTION_MARKER}
+                <style>
                 /* ===== Watermark ===== */
                 body::before {{ /* Creates pseudo-element as first child of body */
                   content: " "; /* Content property required for pseudo-elements, space prevents collapse */
@@ -153,99 +282,26 @@ def export_notebook(notebook_name):
                 </style>
                 
                 <script>
-                document.addEventListener("DOMContentLoaded", () => {{ /* DOMContentLoaded event fires when HTML parsing complete, () => is arrow function */
-                  // === Add line-number spans in code cells ===
-                  document.querySelectorAll("div.input_area pre, div.highlight pre").forEach(pre => {{ /* Returns NodeList of all matching elements, comma separates multiple selectors */
-                    if (!pre.classList.contains("line-numbered")) {{ /* Checks if element has specific class, ! negates boolean */
-                      // Get the text content preserving whitespace
-                      let codeElement = pre.querySelector("code"); /* Returns first matching child element or null */
-                      let textContent = codeElement ? codeElement.textContent : pre.textContent; /* ternary operator: if codeElement exists use its textContent, else use pre's textContent */
-                     
-                      // Split into lines, preserving empty lines
-                      let lines = textContent.split("\\n"); /* Divides string at each newline character into array */
-                      
-                      // Create new structure preserving original formatting
-                      if (codeElement) {{ /* if statement checks if code element exists (truthy) */
-                        // Clear the code element
-                        codeElement.innerHTML = ""; /* Removes all child elements and content */
-                        
-                        // Add each line as a span
-                        lines.forEach((line, index) => {{ /* forEach iterates array, line is current item, index is position */
-                          let span = document.createElement("span"); /* Creates new DOM element */
-                          span.textContent = line + (index < lines.length - 1 ? "\\n" : "");  /* textContent sets text, ternary adds newline except for last line */
-                          codeElement.appendChild(span); /* Adds span as last child of code element */
-                        }});
-                      }} else {{ /* else block executes when codeElement is null/undefined */
-                        // Clear the pre element
-                        pre.innerHTML = ""; /* Empties the pre element */
-                        
-                        // Add each line as a span
-                        lines.forEach((line, index) => {{ /* forEach loop for each line in array */
-                          let span = document.createElement("span"); /* Makes new span element */
-                          span.textContent = line + (index < lines.length - 1 ? "\\n" : ""); /* Set text with conditional newline */
-                          pre.appendChild(span); /* Adds span to pre element */
-                        }});
-                      }}
-                      
-                      pre.classList.add("line-numbered"); /* Adds CSS class to element */
-                    }}
-                  }});
-                
-                  // === Number + collapsible headings ===
-                  let counters = [0,0,0,0,0,0]; /* Array literal with 6 zeros for h1-h6 counters, let declares block-scoped variable */
-                  let allHeadings = document.querySelectorAll( /* Returns all matching elements */
-                    ".text_cell_render h1, .text_cell_render h2, .text_cell_render h3, .text_cell_render h4, .text_cell_render h5, .text_cell_render h6, \
-                     .jp-RenderedHTMLCommon h1, .jp-RenderedHTMLCommon h2, .jp-RenderedHTMLCommon h3, .jp-RenderedHTMLCommon h4, .jp-RenderedHTMLCommon h5, .jp-RenderedHTMLCommon h6"
-                  ); /* Selectors target h1-h6 inside two different parent classes, backslash continues line */
-                
-                  allHeadings.forEach(h => {{ /* forEach iterates NodeList, h is current heading element */
-                    let level = parseInt(h.tagName.substring(1)); /* tagName is "H1", "H2" etc., substring(1) removes "H", parseInt converts to number */
-                    counters[level-1]++; /* Increment counter at index level-1 (arrays are 0-indexed) */
-                    counters.fill(0, level); /* Sets array elements to 0 starting at index 'level' */
-                    let numbering = counters.slice(0, level).join(".");  /* Copies first 'level' elements, join(".") concatenates with dots */
-                
-                    if (!h.querySelector(".heading-number")) {{ /* Check if heading already has number span */
-                      let span = document.createElement("span"); /* Create new span element */
-                      span.className = "heading-number"; /* className property sets class attribute */
-                      span.textContent = numbering + " "; /* textContent sets text with space after number */
-                      h.insertBefore(span, h.firstChild); /* insertBefore adds span before first child of heading */
-                    }}
-                
-                    h.classList.add("collapsible"); /* Add collapsible class to heading */
-                    let section = document.createElement("div"); /* Create div to hold section content */
-                    section.classList.add("section-content"); /* Add class to section div */
-                
-                    let parentCell = h.closest(".cell, .jp-Cell");  /* closest() finds nearest ancestor matching selector */
-                    let next = parentCell.nextElementSibling; /* nextElementSibling gets next element node (skips text nodes) */
-
-                   /* Collect all cells belonging to this section */
-                    while (next) {{ /* while loop continues as long as next is truthy (not null) */
-                      let headingInNext = next.querySelector( /* querySelector searches for heading in next cell */
-                        ".text_cell_render h1, .text_cell_render h2, .text_cell_render h3, .text_cell_render h4, .text_cell_render h5, .text_cell_render h6, \
-                         .jp-RenderedHTMLCommon h1, .jp-RenderedHTMLCommon h2, .jp-RenderedHTMLCommon h3, .jp-RenderedHTMLCommon h4, .jp-RenderedHTMLCommon h5, .jp-RenderedHTMLCommon h6"
-                      );
-                      if (headingInNext) {{ /* If finds a heading in next cell */
-                        let nextLevel = parseInt(headingInNext.tagName.substring(1)); /* Extract heading level number */
-                        if (nextLevel <= level) break; /* break exits while loop if same or higher level heading found */
-                      }}
-                      let temp = next.nextElementSibling; /* Store reference to following element before moving current */
-                      section.appendChild(next); /* Moves 'next' element into section (removes from original location) */
-                      next = temp; /* Update next to the stored reference for next iteration */
+                // ===== Collapsible headings =====
+                // Heading numbers and section-content containers are built at export time (number_headings() in Python),
+                // so one delegated listener on the document handles clicks on every heading
+                document.addEventListener("click", event => {{ /* Click events bubble up from the heading to the document */
+                  let h = event.target.closest(".collapsible"); /* closest() finds the clicked heading, or null if the click was elsewhere */
+                  if (!h) return; /* Not a heading click */
+                  let section = document.getElementById(h.dataset.section); /* data-section holds the id of the heading's section-content div */
+                  if (!section) return;
+                  if (section.style.display === "none") {{ /* Accesses inline CSS display property, === checks strict equality */
+                    section.style.display = ""; /* Removes inline display style, reverts to CSS default */
+                    h.classList.remove("collapsed"); /* Removes the collapsed class */
+                    let deferred = section.querySelector(":scope > template.deferred-section"); /* Contents not built yet (collapsed by default) */
+                    if (deferred) {{
+                      deferred.replaceWith(document.importNode(deferred.content, true)); /* importNode copies the inert contents into the page, their scripts run now */
+                      document.dispatchEvent(new CustomEvent("sectioninstantiated", {{detail: section}})); /* Lets e.g. the lazy Plotly scheduler see the new figures */
                     }}
-                
-                    parentCell.parentNode.insertBefore(section, next); /* parentNode gets parent element, insertBefore adds section before 'next' element (or at end if next is null) */
-
-                    /* Make heading clickable to collapse/expand section */
-                    h.addEventListener("click", () => {{ /* Attaches click event handler, arrow function defines handler */
-                      if (section.style.display === "none") {{ /* Accesses inline CSS display property, === checks strict equality */
-                        section.style.display = ""; /* Removes inline display style, reverts to CSS default */
-                        h.classList.remove("collapsed"); /* Removes the collapsed class */
-                      }} else {{ /* else block runs when section is currently visible */
-                        section.style.display = "none"; /* Hides element completely */
-                        h.classList.add("collapsed"); /* Adds the collapsed class */
-                      }}
-                    }});
-                  }});
+                  }} else {{ /* else block runs when section is currently visible */
+                    section.style.display = "none"; /* Hides element completely */
+                    h.classList.add("collapsed"); /* Adds the collapsed class */
+                  }}
                 }});
                 
                 // ===== Toggle functions =====
@@ -284,33 +340,2041 @@ def export_notebook(notebook_name):
                     Reset View
                   </button>
                 </div>
-                {timestamp_footer}
                 '''
 
-    # Inject into HTML file
-    html_file.write_text(
-        html_file.read_text(encoding = "utf-8") # Read the entire HTML file content as a string (UTF-8 encoding ensures proper character handling)
-        .replace("</head>", html_injection + "</head>"), # Replace the closing </head> tag with our injected CSS+JS + the </head> tag again
-        encoding = "utf-8" # Write the modified string back into the same HTML file (again using UTF-8 encoding)
-    )
+    return html_injection
+
+
+def build_timestamp_footer(exported_at = None):
+    # Footer showing when this HTML file was exported (exported_at: "YYYY-mm-dd HH:MM:SS", default now)
+    exported_at = exported_at or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return f'''
+                <!-- ===== Timestamp Footer ===== -->
+                <footer style="position: fixed; bottom: 5px; right: 10px; font-size: 12px; color: gray; opacity: 0.7;">
+                  Exported on {exported_at}
+                </footer>
+                '''
+
+
+def log(level, message):
+    # Print a timestamped log line, e.g. "2025-09-26 00:19:50 [INFO] ..."
+    print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")} [{level}] {message}', flush = True)
+
+def reserve_html_file(notebook, timestamp_str):
+    # Create a new filename with timestamp (e.g. notebook_YYYYMMDD_HHMMSS.html)
+    # If another export already claimed that name in the same second, append a counter (notebook_YYYYMMDD_HHMMSS_2.html)
+    counter = 1
+    while True:
+        suffix = "" if counter == 1 else f"_{counter}"
+        html_file = notebook.with_name(f'{notebook.stem}_{timestamp_str}{suffix}.html')
+        try:
+            # O_EXCL makes creation atomic, so two worker processes can never claim the same name
+            # https://docs.python.org/3/library/os.html#os.open
+            os.close(os.open(html_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666)) # rw for everyone minus umask, like open()
+            return html_file
+        except FileExistsError: # Name already taken, try the next counter
+            counter += 1
+
+# ===== Incremental export cache =====
+# A JSON manifest next to the notebooks remembers, for each notebook, the cache key of its last export
+# and the HTML file it produced. If the key is unchanged the existing HTML is returned instead of re-rendering.
+CACHE_MANIFEST_NAME = ".nb_export_cache.json"
+CACHE_FORMAT_VERSION = 6 # Manifest/key layout; edits to this script are covered by exporter_source_digest()
+
+@functools.lru_cache(maxsize = None)
+def exporter_source_digest():
+    # Any edit to this script (a new transform, a changed template) invalidates the cache without a manual bump
+    return hashlib.sha256(pathlib.Path(__file__).read_bytes()).hexdigest()
+
+def exporter_version(exporter):
+    # Identifies the rendering engine, so upgrading nbconvert invalidates old cache entries
+    if exporter is None:
+        return "jupyter-nbconvert-cli" # Subprocess fallback, version unknown without paying for another process
+    import nbconvert
+    return f"nbconvert-{nbconvert.__version__}"
+
+def cache_key(notebook_bytes, exporter, html_injection, options):
+    # SHA-256 over everything that determines the exported HTML (except the footer timestamp)
+    # options holds the export settings (site mode, ...) as a JSON-serializable dict
+    # https://docs.python.org/3/library/hashlib.html
+    digest = hashlib.sha256()
+    for part in (str(CACHE_FORMAT_VERSION).encode(), exporter_source_digest().encode(), exporter_version(exporter).encode(),
+                 html_injection.encode("utf-8"), json.dumps(options, sort_keys = True).encode(), notebook_bytes):
+        digest.update(len(part).to_bytes(8, "little")) # Length prefix keeps the parts from running into each other
+        digest.update(part)
+    return digest.hexdigest()
+
+def read_cache_manifest(manifest_file):
+    # Missing or corrupt manifests simply mean "nothing cached yet"
+    try:
+        manifest = json.loads(manifest_file.read_text(encoding = "utf-8"))
+    except (OSError, ValueError):
+        return {}
+    return manifest if isinstance(manifest, dict) else {}
+
+def write_cache_entry(manifest_file, notebook, key, html_file):
+    # Single export in this process (export_notebook, serve)
+    write_cache_entries(manifest_file, [(notebook, key, html_file)])
+
+def write_cache_entries(manifest_file, entries):
+    # One read-modify-write for all (notebook, key, html_file) entries of a manifest, replaced atomically so readers
+    # never see a half-written manifest. Only one process writes: worker processes hand their entries to the parent
+    manifest = read_cache_manifest(manifest_file)
+    for notebook, key, html_file in entries:
+        manifest[notebook.name] = {"key": key, "html": os.path.relpath(html_file, notebook.parent)} # Relative, so site pages work too
+    tmp_file = manifest_file.with_name(f"{manifest_file.name}.{os.getpid()}.tmp")
+    tmp_file.write_text(json.dumps(manifest, indent = 2, sort_keys = True), encoding = "utf-8")
+    os.replace(tmp_file, manifest_file) # https://docs.python.org/3/library/os.html#os.replace
+
+def lookup_cached_html(manifest_file, notebook, key):
+    # Return the previously exported HTML file if the key matches and the file still exists, else None
+    entry = read_cache_manifest(manifest_file).get(notebook.name)
+    if not isinstance(entry, dict) or entry.get("key") != key:
+        return None
+    html_file = notebook.parent / str(entry.get("html", ""))
+    return html_file if html_file.is_file() and html_file.stat().st_size > 0 else None
+
+
+# ===== Site export mode (shared assets) =====
+# Instead of every page inlining plotly.js, the nbconvert theme CSS and our injected CSS/JS, site mode writes
+# them once into <site>/assets/ under content-hashed names and links them from each page, so browsers
+# download and cache them once for the whole report (a changed file gets a new name, so caches never go stale)
+SITE_ASSETS_DIR = "assets"
+SITE_ASSET_MIN_BYTES = 1024 # Smaller inline blocks are cheaper to keep than to fetch separately
+
+# <style>/<script> blocks with their attributes and content
+INLINE_BLOCK_RE = re.compile(r"<(style|script)\b([^>]*)>(.*?)</\1>", re.S | re.I)
+# plotly.js banner at the start of the bundle, e.g. "/**\n* plotly.js v2.35.2" or, for a partial bundle,
+# "/**\n* plotly.js (basic - minified) v2.35.2"
+PLOTLY_BANNER_RE = re.compile(r"/\*\*\s*\* plotly\.js (?:\(([\w\s\-]+)\) )?v([\w.\-]+)")
+# Notebook outputs (plotly.py "notebook" renderer) wrap the bundle in a RequireJS module definition
+PLOTLY_AMD_RE = re.compile(r"define\('plotly', function\(require, exports, module\) \{\s*(/\*\*\s*\* plotly\.js (?:\([^)]*\) )?v.*?)\s*\}\);(?=\s*require\(\['plotly'\])", re.S)
+# Standalone figure pages (fig.write_html) inline the bare bundle in its own <script> tag
+PLOTLY_SCRIPT_RE = re.compile(r"<script\b([^>]*)>\s*(/\*\*\s*\* plotly\.js (?:\([^)]*\) )?v.*?)</script>", re.S)
+
+def write_content_addressed(directory, prefix, extension, data):
+    # Write bytes to <directory>/<prefix><hash><extension> (once) and return the file name
+    # Same content, same name: later pages/cells just reference the existing file
+    target = directory / f"{prefix}{hashlib.sha256(data).hexdigest()[:16]}{extension}"
+    if not target.exists():
+        directory.mkdir(parents = True, exist_ok = True)
+        tmp_file = target.with_name(f"{target.name}.{os.getpid()}.tmp") # Write then rename, parallel workers never see half a file
+        tmp_file.write_bytes(data)
+        os.replace(tmp_file, target) # https://docs.python.org/3/library/os.html#os.replace
+    return target.name
+
+def write_site_asset(site_dir, name, extension, content):
+    # Write content to <site>/assets/<name>-<hash><extension> and return its URL relative to the pages
+    return f"{SITE_ASSETS_DIR}/{write_content_addressed(site_dir / SITE_ASSETS_DIR, name + '-', extension, content.encode('utf-8'))}"
+
+def externalize_site_assets(html, site_dir):
+    # Move plotly.js (anywhere in the page) and large <head> styles/scripts into shared asset files
+
+    def plotly_asset(bundle):
+        partial, version = PLOTLY_BANNER_RE.match(bundle).groups()
+        name = f"plotly-{partial.split(' - ')[0]}" if partial else "plotly" # e.g. plotly-basic-2.35.2-<hash>.js
+        return write_site_asset(site_dir, f"{name}-{version}", ".js", bundle)
+
+    # Notebook pages: keep the RequireJS module name "plotly" but let RequireJS load it from the asset file
+    # (RequireJS module paths are written without ".js") https://requirejs.org/docs/api.html#config-paths
+    html = PLOTLY_AMD_RE.sub(
+        lambda m: f'require.config({{paths: {{plotly: "{plotly_asset(m.group(1))[:-len(".js")]}"}}}});', html)
+    # Standalone figure pages: a plain <script src>, same asset file as the notebook pages
+    html = PLOTLY_SCRIPT_RE.sub(lambda m: f'<script{m.group(1)} src="{plotly_asset(m.group(2))}"></script>', html)
+
+    def head_block(match):
+        tag, attrs, content = match.group(1).lower(), match.group(2), match.group(3)
+        if len(content) < SITE_ASSET_MIN_BYTES:
+            return match.group(0)
+        if tag == "style":
+            return f'<link rel="stylesheet" href="{write_site_asset(site_dir, "style", ".css", content)}">'
+        script_type = re.search(r"""type\s*=\s*["']([^"']*)""", attrs)
+        if "src=" in attrs or (script_type and script_type.group(1).lower() != "text/javascript"):
+            return match.group(0) # Leave modules, MathJax config and already external scripts alone
+        return f'<script{attrs} src="{write_site_asset(site_dir, "script", ".js", content)}"></script>'
+
+    # Only <head> blocks are shared between pages, body scripts (figure data) are page specific
+    head_end = html.find("</head>")
+    if head_end < 0:
+        return html
+    return INLINE_BLOCK_RE.sub(head_block, html[:head_end]) + html[head_end:]
+
+def add_html_page_to_site(html_path, site_dir, **plotly_options):
+    # Already exported HTML (e.g. a fig.write_html() figure) copied into the site with shared assets
+    # plotly_options (lazy_plotly, typed_array_length, ...) are passed on to transform_plotly()
+    site_dir.mkdir(parents = True, exist_ok = True)
+    page = site_dir / html_path.name
+    html = transform_plotly(html_path.read_text(encoding = "utf-8"), site_dir, **plotly_options)
+    page.write_text(externalize_site_assets(html, site_dir), encoding = "utf-8")
+    return page
+
+
+# ===== Code line numbers =====
+# Every line of a highlighted code block is wrapped in its own <span> (the CSS counter in build_html_injection()
+# numbers them) while the Pygments highlighting spans are kept. Doing this at export time saves the browser
+# from rebuilding every code cell's DOM on load.
+HIGHLIGHT_PRE_RE = re.compile(r'(<div class="highlight[^"]*">\s*)<pre>(.*?)</pre>', re.S) # Pygments output, bare <pre> only
+CODE_TOKEN_RE = re.compile(r"(<[^>]*>)|([^<]+)") # Either a tag or the text between tags
+
+def wrap_code_lines(code_html):
+    # Split highlighted code into one <span> per line, closing any highlighting span still open at the end
+    # of a line and reopening it on the next one (e.g. a multi-line string is one Pygments token)
+    if code_html.endswith("\n"):
+        code_html = code_html[:-1] # Pygments ends with a newline, which would otherwise become an empty numbered line
+    open_tags = [] # Highlighting tags open at the current position
+    parts = ["<span>"]
+    for tag, text in CODE_TOKEN_RE.findall(code_html):
+        if tag:
+            if tag.startswith("</"):
+                if open_tags:
+                    open_tags.pop()
+            elif not tag.endswith("/>"):
+                open_tags.append(tag)
+            parts.append(tag)
+        else:
+            lines = text.split("\n")
+            parts.append(lines[0])
+            for line in lines[1:]:
+                # Close the open tags, end this line (keeping the newline for copy/paste), reopen them on the next line
+                parts.append("</span>" * len(open_tags) + "\n</span><span>" + "".join(open_tags) + line)
+    parts.append("</span>")
+    return "".join(parts)
+
+def number_code_lines(html):
+    # Turn every highlighted <pre> into <pre class="line-numbered"> with one <span> per line
+    return HIGHLIGHT_PRE_RE.sub(lambda m: f'{m.group(1)}<pre class="line-numbered">{wrap_code_lines(m.group(2))}</pre>', html)
+
+
+# ===== Heading numbers and collapsible sections =====
+# One linear pass over the rendered cells: every heading in a markdown cell gets its "1.2.3 " number span and
+# the cells after it, up to the next heading of the same or a higher level, are wrapped in a
+# <div class="section-content"> that the heading collapses (the browser only attaches one click listener)
+CELL_START_RE = re.compile(r'<div class="jp-Cell[ "]') # Top-level cell containers in nbconvert's lab template (not jp-Cell-inputWrapper etc.)
+HEADING_RE = re.compile(r"<h([1-6])\b([^>]*)>")
+
+def add_class(attrs, class_name):
+    # Add a class to a tag's attribute string, merging with an existing class attribute
+    match = re.search(r'\sclass="([^"]*)"', attrs)
+    if match is None:
+        return f'{attrs} class="{class_name}"'
+    return f'{attrs[:match.start()]} class="{(match.group(1) + " " + class_name).strip()}"{attrs[match.end():]}'
+
+def new_heading_state():
+    # Numbering state carried from one cell to the next
+    return {"counters": [0] * 6, # h1-h6 counters
+            "open_sections": [], # Levels of the section-content divs currently open
+            "section_count": 0}
+
+def number_cell_headings(cell, state):
+    # Number the headings of one cell; returns the cell preceded by the section divs it closes
+    # and followed by the section divs it opens
+    counters = state["counters"]
+    open_sections = state["open_sections"]
+    closes = 0 # Open sections to close before this cell
+    opened = [] # (level, heading index) of the sections this cell opens, in nesting order
+
+    is_markdown = "jp-MarkdownCell" in cell[:200] # Only the cell's own class attribute, not its content
+    levels = [int(m.group(1)) for m in HEADING_RE.finditer(cell)] if is_markdown else []
+
+    # A heading ends every section of the same or a deeper level
+    for index, level in enumerate(levels):
+        while opened and opened[-1][0] >= level: # Section of an earlier heading in this cell would be empty, drop it
+            opened.pop()
+        if not opened:
+            while open_sections and open_sections[-1] >= level:
+                open_sections.pop()
+                closes += 1
+        opened.append((level, index))
+
+    section_ids = {} # Heading index -> section number, for the headings that own a section
+    for _, index in opened:
+        state["section_count"] += 1
+        section_ids[index] = state["section_count"]
+    heading_index = iter(range(len(levels)))
+
+    def number_heading(match):
+        level, attrs, index = int(match.group(1)), match.group(2), next(heading_index)
+        counters[level - 1] += 1 # Increment this level, reset the deeper ones
+        counters[level:] = [0] * (6 - level)
+        numbering = ".".join(str(c) for c in counters[:level])
+        if index in section_ids:
+            attrs = add_class(attrs, "collapsible") + f' data-section="section-{section_ids[index]}"'
+        return f'<h{level}{attrs}><span class="heading-number">{numbering} </span>'
+
+    if levels:
+        cell = HEADING_RE.sub(number_heading, cell)
+
+    open_sections.extend(level for level, _ in opened)
+    return ("</div>" * closes + cell
+            + "".join(f'<div class="section-content" id="section-{section_ids[index]}">' for _, index in opened))
+
+def number_headings(html):
+    # Number headings and wrap their sections; returns the HTML unchanged if it has no cells
+    cell_starts = [m.start() for m in CELL_START_RE.finditer(html)]
+    if not cell_starts:
+        return html
+    body_end = html.find("</main>", cell_starts[-1])
+    if body_end < 0:
+        body_end = html.find("</body>", cell_starts[-1])
+    if body_end < 0:
+        return html
+    boundaries = cell_starts + [body_end]
+
+    state = new_heading_state()
+    parts = [html[:cell_starts[0]]]
+    parts.extend(number_cell_headings(html[start:end], state) for start, end in zip(boundaries, boundaries[1:]))
+    parts.append("</div>" * len(state["open_sections"]))
+    parts.append(html[body_end:])
+    return "".join(parts)
+
+
+# ===== Collapsed-by-default sections =====
+# Hiding a section with display: none still costs parsing, layout and running every output inside it.
+# Sections chosen by heading level or size are exported collapsed with their contents in an inert <template>:
+# the browser parses it but builds nothing, and the click handler in build_html_injection() instantiates it on first expand.
+# https://developer.mozilla.org/en-US/docs/Web/HTML/Element/template
+SECTION_START_RE = re.compile(r'<div class="section-content" id="section-(\d+)">')
+SECTION_HEADING_RE = re.compile(r'<h([1-6])\b([^>]*\sdata-section="section-(\d+)"[^>]*)>') # Headings owning a section
+DIV_TAG_RE = re.compile(r"<(/?)div\b")
+
+def matching_div_end(html, start):
+    # Position of the </div> closing the <div> at start, -1 if it isn't closed
+    depth = 0
+    for match in DIV_TAG_RE.finditer(html, start):
+        depth += -1 if match.group(1) else 1
+        if depth == 0:
+            return match.start()
+    return -1
+
+def defer_sections(html, heading_levels, collapse_level, collapse_min_bytes, deferred):
+    # Move the contents of the chosen sections into <template> elements, adding their numbers to deferred
+    # Sections inside a deferred one are handled too, so expanding a section only builds its own level
+    parts, position = [], 0
+    while (match := SECTION_START_RE.search(html, position)) is not None:
+        end = matching_div_end(html, match.start())
+        if end < 0:
+            break
+        number, content = int(match.group(1)), html[match.end():end]
+        level = heading_levels.get(number, 6)
+        if (collapse_level and level >= collapse_level) or (collapse_min_bytes and len(content) >= collapse_min_bytes):
+            content = defer_sections(content, heading_levels, collapse_level, collapse_min_bytes, deferred)
+            parts.extend([html[position:match.start()],
+                          f'<div class="section-content" id="section-{number}" style="display: none">'
+                          f'<template class="deferred-section">{content}</template>'])
+            deferred.add(number)
+            position = end # The section's own </div> is copied with the rest
+        else:
+            parts.append(html[position:match.end()])
+            position = match.end() # Carry on inside the section, nested sections may be chosen
+    parts.append(html[position:])
+    return "".join(parts)
+
+def collapse_sections(html, collapse_level = None, collapse_min_bytes = None):
+    # Export sections collapsed by default: headings of level collapse_level or deeper (e.g. 3 = h3-h6)
+    # and/or sections holding at least collapse_min_bytes characters of HTML
+    heading_levels = {int(m.group(3)): int(m.group(1)) for m in SECTION_HEADING_RE.finditer(html)}
+    deferred = set()
+    html = defer_sections(html, heading_levels, collapse_level, collapse_min_bytes, deferred)
+
+    def mark_collapsed(match): # Same state the click handler sets when collapsing
+        if int(match.group(3)) not in deferred:
+            return match.group()
+        return f"<h{match.group(1)}{add_class(match.group(2), 'collapsed')}>"
+
+    return SECTION_HEADING_RE.sub(mark_collapsed, html) if deferred else html
+
+
+# ===== Image extraction =====
+# nbconvert embeds every matplotlib/seaborn figure as a base64 data: URI, which is a third bigger than the image,
+# blocks HTML parsing and can't be cached or lazily loaded. Extraction writes each image once to
+# <html dir>/images/<hash>.<ext> (identical images across cells and notebooks share one file) and
+# points the <img> tag at it with lazy loading and its real size, so the layout doesn't jump while scrolling.
+IMAGES_DIR = "images"
+IMAGE_EXTENSIONS = {"image/png": ".png", "image/jpeg": ".jpg", "image/gif": ".gif"}
+
+# <img ... src="data:image/png;base64,..." ...> with the attributes before and after src
+INLINE_IMAGE_RE = re.compile(r'<img\b([^>]*?)\ssrc="data:(image/(?:png|jpeg|gif));base64,([^"]*)"([^>]*)>', re.I)
+
+def image_size(data, mime_type):
+    # Return (width, height) in pixels read from the image header, or None if it can't be determined
+    # PNG: https://www.w3.org/TR/png/#11IHDR, GIF: https://www.w3.org/Graphics/GIF/spec-gif89a.txt
+    if mime_type == "image/png" and data[12:16] == b"IHDR":
+        return struct.unpack(">II", data[16:24])
+    if mime_type == "image/gif" and data[:4] == b"GIF8":
+        return struct.unpack("<HH", data[6:10])
+    if mime_type == "image/jpeg":
+        # Walk the JPEG segments until a start-of-frame marker, which holds height then width
+        # https://www.w3.org/Graphics/JPEG/itu-t81.pdf (Annex B)
+        position = 2
+        while position + 9 <= len(data) and data[position] == 0xFF:
+            marker, length = data[position + 1], struct.unpack(">H", data[position + 2:position + 4])[0]
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                height, width = struct.unpack(">HH", data[position + 5:position + 9])
+                return width, height
+            position += 2 + length
+    return None
+
+def extract_inline_images(html, html_dir):
+    # Replace base64 <img> sources with content-addressed files in <html_dir>/images
+
+    def replace_image(match):
+        before, mime_type, encoded, after = match.groups()
+        data = base64.b64decode(encoded) # Non-base64 characters such as line breaks are ignored
+        name = write_content_addressed(html_dir / IMAGES_DIR, "", IMAGE_EXTENSIONS[mime_type.lower()], data)
+        attrs = f'{before} src="{IMAGES_DIR}/{name}" loading="lazy" decoding="async"'
+        size = image_size(data, mime_type.lower())
+        if size and not re.search(r"\s(width|height)\s*=", before + after): # Keep sizes nbconvert took from output metadata
+            attrs += f' width="{size[0]}" height="{size[1]}"' # Reserves the space before the image loads (CSS keeps height:auto)
+        return f"<img{attrs}{after}>"
+
+    return INLINE_IMAGE_RE.sub(replace_image, html)
+
+
+# ===== Plotly figures (lazy drawing, shared templates, typed arrays, downsampling) =====
+# Plotly's HTML renderer writes every figure as a <div> plus a script calling Plotly.newPlot(id, data, layout, config)
+# straight away, so a page with many figures builds all of them while loading. The lazy rewrite keeps the <div>
+# (its inline height reserves the space), moves the arguments into an inert JSON <script>, and one
+# IntersectionObserver draws each figure when it comes near the viewport (and can purge it again when far away).
+# In site mode the arguments can live in their own content-addressed assets/figure-<hash>.json instead, fetched
+# only when the figure comes near, so the page no longer grows with the number of charts.
+# Every figure also carries its own copy of the full layout.template (defaults for every trace type); identical
+# templates can be stored once per page and referenced by each figure instead.
+# Long numeric arrays (heatmap z matrices, ROC curves, raw scatter points) can be written as base64 typed arrays
+# {"dtype": "f8", "bdata": "...", "shape": "rows, cols"}, which plotly.js >= 2.28 decodes without parsing decimal text.
+# Traces with far more points than a screen can show can be downsampled at export time, keeping their shape:
+# LTTB (Largest-Triangle-Three-Buckets) for lines, the lowest and highest point of each x bin for markers.
+# https://skemman.is/bitstream/1946/15343/3/SS_MSthesis.pdf (LTTB)
+# https://developer.mozilla.org/en-US/docs/Web/API/Intersection_Observer_API
+PLOTLY_FIGURE_RE = re.compile(
+    # The notebook renderer writes class before id, fig.write_html() id before class
+    r'<div (?=class="plotly-graph-div" |id="[^"]+" class="plotly-graph-div")(?:class="plotly-graph-div" )?id="([^"]+)"'
+    r'(?: class="plotly-graph-div")?([^>]*)></div>\s*<script type="text/javascript">\s*'
+    r'(?:require\(\["plotly"\], function\(Plotly\) \{\s*)?' # Wrapper of the require.js based notebook renderer
+    r'window\.PLOTLYENV=window\.PLOTLYENV \|\| \{\};\s*(?:window\.PLOTLYENV\.BASE_URL=[^;]*;\s*)?'
+    r'if \(document\.getElementById\("\1"\)\) \{\s*Plotly\.newPlot\(\s*"\1",\s*')
+PLOTLY_DIV_RE = re.compile(r'<div (?:id="[^"]+" )?class="plotly-graph-div"') # Any figure <div>, parsed or not
+PLOTLY_ARGUMENT_SEPARATOR_RE = re.compile(r"\s*,\s*")
+PLOTLY_DRAW_MARGIN = "1000px" # Start drawing a figure this far below (or above) the viewport
+PLOTLY_PURGE_MARGIN = "5000px" # With purging, free figures once they are this far away
+JSON_DECODER = json.JSONDecoder()
+TYPED_ARRAY_MIN_LENGTH = 100 # Default number of values from which an array is written as a typed array
+TYPED_ARRAY_PLOTLY_VERSION = (2, 28) # First plotly.js release decoding typed arrays
+# Smallest integer dtype holding all values: (plotly dtype, struct format, min, max)
+# https://docs.python.org/3/library/struct.html#format-characters
+TYPED_ARRAY_INTEGER_DTYPES = [("u1", "B", 0, 2**8 - 1), ("i1", "b", -2**7, 2**7 - 1), ("u2", "H", 0, 2**16 - 1),
+                              ("i2", "h", -2**15, 2**15 - 1), ("u4", "I", 0, 2**32 - 1), ("i4", "i", -2**31, 2**31 - 1)]
+TYPED_ARRAY_FORMATS = {"f4": "f", "f8": "d", **{dtype: code for dtype, code, _, _ in TYPED_ARRAY_INTEGER_DTYPES}}
+DOWNSAMPLE_POINTS = 5000 # Default number of points a trace is downsampled to
+DOWNSAMPLE_TRACE_TYPES = {"scatter", "scattergl"}
+TYPED_ARRAY_SKIPPED_ATTRIBUTES = {"text", "hovertext", "ids", "selectedpoints"} # Numbers shown or matched as strings
+# plotly.js loaded from a CDN instead of embedded, e.g. https://cdn.plot.ly/plotly-2.35.2.min.js
+PLOTLY_CDN_RE = re.compile(r"plotly-(\d+\.\d+\.\d+)(?:\.min)?\.js")
+
+def parse_plotly_figures(html):
+    # Yield (start, end, figure) for every figure written by plotly's HTML renderer, where html[start:end] is the
+    # <div> + <script> pair and figure is {"id", "attrs", "data", "layout", "config"} with the decoded newPlot arguments
+    # Figures that don't parse (e.g. hand-written scripts) are skipped and stay as they are
+    position = 0
+    while (match := PLOTLY_FIGURE_RE.search(html, position)) is not None:
+        position = match.end()
+        try:
+            arguments = []
+            for name in ("data", "layout", "config"):
+                value, position = JSON_DECODER.raw_decode(html, position) # Decodes one JSON value, returns where it ended
+                arguments.append(value)
+                separator = PLOTLY_ARGUMENT_SEPARATOR_RE.match(html, position)
+                if separator:
+                    position = separator.end()
+        except ValueError:
+            continue
+        end = html.find("</script>", position)
+        if end < 0:
+            break
+        yield match.start(), end + len("</script>"), dict(zip(("data", "layout", "config"), arguments),
+                                                          id = match.group(1), attrs = match.group(2))
+
+def script_json(value):
+    # JSON for an inline <script>: compact, and "<" escaped so no "</script>" or "<!--" can end the element early
+    return json.dumps(value, separators = (",", ":")).replace("<", "\\u003c")
+
+def plotly_figure_arguments(figure):
+    # The figure's newPlot arguments as one JSON object, as read by plotly_lazy_script()
+    arguments = {"data": figure["data"], "layout": figure["layout"], "config": figure["config"]}
+    if "template" in figure: # Key of a shared template (see hoist_plotly_template())
+        arguments["template"] = figure["template"]
+    return script_json(arguments)
+
+def plotly_figure_placeholder(figure, site_dir = None):
+    # Empty figure <div> plus its newPlot arguments as an inert JSON <script>, drawn by plotly_lazy_script()
+    # With site_dir, the arguments are written to a site asset instead and the <div> points at it (data-src)
+    if site_dir is not None:
+        source = write_site_asset(site_dir, "figure", ".json", plotly_figure_arguments(figure))
+        return f'<div class="plotly-graph-div plotly-lazy" id="{figure["id"]}" data-src="{source}"{figure["attrs"]}></div>'
+    return (f'<div class="plotly-graph-div plotly-lazy" id="{figure["id"]}"{figure["attrs"]}></div>'
+            f'<script type="application/json" class="plotly-figure" data-target="{figure["id"]}">{plotly_figure_arguments(figure)}</script>')
+
+def plotly_lazy_script(purge = False):
+    # Scheduler drawing the placeholders near the viewport, optionally purging the ones far away
+    purge_observer = f'''
+                  let purger = new IntersectionObserver(entries => entries.forEach(entry => {{ /* Figures leaving the wide margin */
+                    let gd = entry.target;
+                    if (entry.isIntersecting || !gd.dataset.drawn) return;
+                    delete gd.dataset.drawn; /* Drawn again when it comes back */
+                    withPlotly(Plotly => Plotly.purge(gd)); /* Frees the figure's DOM, WebGL contexts and data, the div keeps its height */
+                  }}), {{rootMargin: "{PLOTLY_PURGE_MARGIN} 0px"}});
+                  figures.forEach(gd => purger.observe(gd));''' if purge else ""
+    return f'''
+                <script>
+                // ===== Lazy Plotly figures =====
+                (() => {{ /* Arrow function called right away, keeps the variables out of the global scope */
+                  function withPlotly(callback) {{ /* plotly.js is either a global or a require.js module in notebooks */
+                    if (window.Plotly) callback(window.Plotly); else require(["plotly"], callback);
+                  }}
+                  let figures = document.querySelectorAll(".plotly-lazy"); /* Not those still inside a <template> */
+                  function loadFigure(gd) {{ /* The newPlot arguments, from the page or from the figure's own JSON file (site mode) */
+                    if (!gd.dataset.src)
+                      return Promise.resolve(JSON.parse(document.querySelector(`script.plotly-figure[data-target="${{gd.id}}"]`).textContent));
+                    return fetch(gd.dataset.src).then(response => {{ /* The browser's HTTP cache serves it again after a purge */
+                      if (!response.ok) throw new Error(`${{response.status}} ${{response.statusText}}`);
+                      return response.json();
+                    }});
+                  }}
+                  let drawer = new IntersectionObserver(entries => entries.forEach(entry => {{ /* Figures entering the margin */
+                    let gd = entry.target;
+                    if (!entry.isIntersecting || gd.dataset.drawn) return;
+                    gd.dataset.drawn = "1";
+                    loadFigure(gd).then(figure => {{
+                      if (figure.template) figure.layout.template = structuredClone(window.plotlyTemplates[figure.template]); /* Own copy of the shared template */
+                      withPlotly(Plotly => Plotly.newPlot(gd, figure.data, figure.layout, figure.config));
+                    }}).catch(error => {{
+                      delete gd.dataset.drawn; /* Tried again when it next comes into view */
+                      gd.textContent = `Figure could not be loaded (${{error.message}})`;
+                    }});
+                  }}), {{rootMargin: "{PLOTLY_DRAW_MARGIN} 0px"}}); /* rootMargin grows the viewport by this much above and below */
+                  figures.forEach(gd => drawer.observe(gd));{purge_observer}
+                  document.addEventListener("sectioninstantiated", event => {{ /* Figures of a collapsed-by-default section, once expanded */
+                    event.detail.querySelectorAll(".plotly-lazy").forEach(gd => {{
+                      drawer.observe(gd);{" purger.observe(gd);" if purge else ""}
+                    }});
+                  }});
+                }})();
+                </script>
+                '''
+
+def hoist_plotly_template(figure, templates):
+    # Move the figure's layout.template into templates (one entry per distinct template), keyed by its content hash
+    template = figure["layout"].pop("template", None)
+    if template is None:
+        return False
+    key = hashlib.sha256(json.dumps(template, sort_keys = True).encode("utf-8")).hexdigest()[:12]
+    templates.setdefault(key, template)
+    figure["template"] = key
+    return True
+
+def plotly_templates_script(templates):
+    # The shared templates, defined once at the start of the <body> before any figure script runs
+    entries = ",\n".join(f"  {json.dumps(key)}: {script_json(template)}" for key, template in templates.items())
+    return f'''<script>
+// ===== Shared Plotly templates (identical layout.template of several figures, stored once) =====
+window.plotlyTemplates = {{
+{entries}
+}};
+</script>'''
+
+def plotly_figure_script(figure):
+    # Figure <div> + script drawing it right away, with its layout.template taken from the shared templates
+    layout = script_json(figure["layout"])
+    if "template" in figure:
+        layout = f"Object.assign({layout}, {{template: structuredClone(window.plotlyTemplates[{json.dumps(figure['template'])}])}})"
+    arguments = ", ".join([json.dumps(figure["id"]), script_json(figure["data"]), layout, script_json(figure["config"])])
+    return (f'<div class="plotly-graph-div" id="{figure["id"]}"{figure["attrs"]}></div> <script type="text/javascript">'
+            f'(window.Plotly ? function (draw) {{ draw(window.Plotly); }} : function (draw) {{ require(["plotly"], draw); }})'
+            f'(function (Plotly) {{ Plotly.newPlot({arguments}); }});</script>')
+
+def plotly_page_version(html):
+    # (major, minor) of the plotly.js the page loads, from its embedded bundle or a CDN URL, None if unknown
+    banner = PLOTLY_BANNER_RE.search(html)
+    version = banner.group(2) if banner else (PLOTLY_CDN_RE.search(html) or [None, None])[1]
+    try:
+        return tuple(int(part) for part in version.split(".")[:2])
+    except (AttributeError, ValueError):
+        return None
+
+def typed_array(values, min_length, float32 = False):
+    # Typed array form of a list of numbers (or of equal-length rows of numbers), None if not numeric or too short,
+    # or if it wouldn't be smaller than the JSON text (short decimals such as 12.5 take fewer characters than 8 bytes)
+    text_length = len(script_json(values))
+    shape = None
+    if all(isinstance(row, list) for row in values) and values: # 2D, e.g. a heatmap's z
+        if len({len(row) for row in values}) != 1:
+            return None
+        shape = f"{len(values)}, {len(values[0])}"
+        values = [value for row in values for value in row]
+    if len(values) < min_length or not all(value is None or type(value) in (int, float) for value in values): # type() leaves out bools
+        return None
+    values = [float("nan") if value is None else value for value in values] # Missing values (masked heatmap cells): NaN, a gap like null
+    if all(type(value) is int or value.is_integer() for value in values): # Whole floats (12.0) are stored as integers too
+        values = [int(value) for value in values]
+        low, high = min(values), max(values)
+        dtype, code = next(((dtype, code) for dtype, code, smallest, largest in TYPED_ARRAY_INTEGER_DTYPES
+                            if smallest <= low and high <= largest), ("f8", "d"))
+        if code == "d" and max(-low, high) > 2**53: # Not exact as a double either
+            return None
+    else:
+        dtype, code = ("f4", "f") if float32 else ("f8", "d")
+    try:
+        data = struct.pack(f"<{len(values)}{code}", *values) # plotly.js reads little-endian
+    except OverflowError: # Beyond the float32 range
+        dtype, data = "f8", struct.pack(f"<{len(values)}d", *values)
+    array = {"dtype": dtype, "bdata": base64.b64encode(data).decode("ascii")}
+    if shape:
+        array["shape"] = shape
+    return array if len(script_json(array)) < text_length else None
+
+def encode_typed_arrays(attributes, min_length, float32 = False):
+    # Replace the long numeric arrays of a trace (nested attributes such as marker.color included) in place
+    # Returns whether anything was replaced
+    changed = False
+    for key, value in attributes.items():
+        if isinstance(value, dict):
+            changed |= encode_typed_arrays(value, min_length, float32)
+        elif isinstance(value, list) and value and isinstance(value[0], dict): # e.g. splom dimensions
+            for item in value:
+                if isinstance(item, dict):
+                    changed |= encode_typed_arrays(item, min_length, float32)
+        elif isinstance(value, list) and key not in TYPED_ARRAY_SKIPPED_ATTRIBUTES:
+            array = typed_array(value, min_length, float32)
+            if array is not None:
+                attributes[key] = array
+                changed = True
+    return changed
+
+def plain_array(value):
+    # List of the values of a trace array, decoding 1D typed arrays; None for anything else
+    if isinstance(value, list):
+        return value
+    if isinstance(value, dict) and value.get("dtype") in TYPED_ARRAY_FORMATS and "shape" not in value:
+        try:
+            data = base64.b64decode(value["bdata"])
+            code = TYPED_ARRAY_FORMATS[value["dtype"]]
+            return list(struct.unpack(f"<{len(data) // struct.calcsize(code)}{code}", data))
+        except (KeyError, TypeError, ValueError, struct.error):
+            return None
+    return None
+
+def is_number(value):
+    return type(value) in (int, float) and value == value # value == value leaves out NaN
+
+def lttb_indices(x, y, threshold):
+    # Indices of the threshold points keeping the visual shape of the line (first and last point included):
+    # one point per bucket, the one forming the largest triangle with the previously kept point and the next bucket's mean
+    count = len(y)
+    bucket_size = (count - 2) / (threshold - 2)
+    indices, previous = [0], 0
+    for bucket in range(threshold - 2):
+        start, end = int(bucket * bucket_size) + 1, int((bucket + 1) * bucket_size) + 1
+        next_start, next_end = end, min(int((bucket + 2) * bucket_size) + 1, count)
+        mean_x = sum(x[next_start:next_end]) / (next_end - next_start)
+        mean_y = sum(y[next_start:next_end]) / (next_end - next_start)
+        previous_x, previous_y = x[previous], y[previous]
+        previous = max(range(start, end), key = lambda i: abs((previous_x - mean_x) * (y[i] - previous_y)
+                                                               - (previous_x - x[i]) * (mean_y - previous_y)))
+        indices.append(previous)
+    indices.append(count - 1)
+    return indices
+
+def minmax_indices(y, threshold):
+    # Indices of the first and last point plus the lowest and highest point of each bucket of consecutive points
+    # (buckets by point index like LTTB, not by x: x may repeat or go back, e.g. a few categories or epochs)
+    count = len(y)
+    buckets = max((threshold - 2) // 2, 1)
+    bucket_size = (count - 2) / buckets
+    indices = {0, count - 1}
+    for bucket in range(buckets):
+        points = range(int(bucket * bucket_size) + 1, int((bucket + 1) * bucket_size) + 1)
+        if points:
+            indices.update((min(points, key = y.__getitem__), max(points, key = y.__getitem__)))
+    return sorted(indices)
+
+def take_points(attributes, count, indices):
+    # Keep only the given points in every per-point array of a trace (x, y, text, customdata, marker.color, ...)
+    for key, value in attributes.items():
+        values = plain_array(value)
+        if values is not None and len(values) == count:
+            attributes[key] = [values[i] for i in indices]
+        elif isinstance(value, dict):
+            take_points(value, count, indices)
+
+def downsample_trace(trace, max_points):
+    # Downsample a scatter trace of more than max_points points in place, returns its original point count or None
+    y = plain_array(trace.get("y"))
+    if (trace.get("type", "scatter") not in DOWNSAMPLE_TRACE_TYPES or y is None or len(y) <= max(max_points, 2)
+            or str(trace.get("fill", "none")).startswith("tonext")): # Fills between traces need their points aligned
+        return None
+    if not all(is_number(value) for value in y): # Gaps (null) would be closed or moved
+        return None
+    count = len(y)
+    x = plain_array(trace.get("x"))
+    if x is None:
+        if "x" in trace or not all(is_number(trace.get(key, 0)) for key in ("x0", "dx")): # e.g. a date x0
+            return None
+        x = [trace.get("x0", 0) + i * trace.get("dx", 1) for i in range(count)] # The implicit x, written out below
+        trace["x"] = x
+        trace.pop("x0", None)
+        trace.pop("dx", None)
+    elif len(x) != count:
+        return None
+    positions = x if all(is_number(value) for value in x) else range(count) # Dates, categories: by position
+    mode = trace.get("mode", "lines" if count >= 20 else "lines+markers") # plotly's default
+    if "lines" in mode:
+        indices = lttb_indices(positions, y, max(max_points, 3))
+    else:
+        indices = minmax_indices(y, max_points)
+    take_points(trace, count, indices)
+    return count
+
+def downsample_figure(figure, max_points):
+    # Downsample the figure's oversized traces, noting the original point counts on the figure
+    notes = []
+    for number, trace in enumerate(figure["data"]):
+        count = downsample_trace(trace, max_points)
+        if count is not None:
+            name = trace.get("name") or f"trace {number}"
+            notes.append(f"{name}: {len(trace['y']):,} of {count:,} points")
+    if not notes:
+        return False
+    figure["layout"].setdefault("annotations", []).append({
+        "text": "Downsampled for display (" + "; ".join(notes) + ")", "showarrow": False,
+        "xref": "paper", "yref": "paper", "x": 1, "y": 1, "xanchor": "right", "yanchor": "bottom",
+        "font": {"size": 10, "color": "gray"}})
+    return True
+
+def rewrite_plotly_figures(html, lazy = False, purge = False, share_templates = False, typed_array_length = None,
+                           float32 = False, downsample_points = None, site_dir = None):
+    # One pass over the page's plotly figures:
+    # lazy: replace every figure with a lazily drawn placeholder and add the scheduler before </body>
+    # share_templates: store identical layout templates once per page instead of once per figure
+    # typed_array_length: write trace arrays of at least this many numbers as base64 typed arrays (float32: 4-byte floats)
+    # downsample_points: downsample scatter traces of more points than this (before they are encoded)
+    # site_dir: with lazy, write each figure's arguments to a JSON asset of the site, fetched when drawn
+    if typed_array_length and (plotly_page_version(html) or (0, 0)) < TYPED_ARRAY_PLOTLY_VERSION:
+        typed_array_length = None # An older (or unknown) plotly.js would draw the base64 objects as garbage
+    templates = {}
+    parts, last = [], 0
+    for start, end, figure in parse_plotly_figures(html):
+        hoisted = share_templates and hoist_plotly_template(figure, templates)
+        encoded = bool(downsample_points) and downsample_figure(figure, downsample_points)
+        if typed_array_length:
+            for trace in figure["data"]:
+                encoded |= encode_typed_arrays(trace, typed_array_length, float32)
+        if lazy:
+            replacement = plotly_figure_placeholder(figure, site_dir)
+        elif hoisted or encoded:
+            replacement = plotly_figure_script(figure)
+        else:
+            replacement = html[start:end] # Nothing changed, keep plotly's own script
+        parts.extend([html[last:start], replacement])
+        last = end
+    if not parts: # No figures, no scripts
+        return html
+    parts.append(html[last:])
+    html = "".join(parts)
+    if templates:
+        html = insert_after_body_start(html, plotly_templates_script(templates))
+    if lazy:
+        html = insert_before_body_end(html, plotly_lazy_script(purge))
+    return html
+
+def insert_after_body_start(html, snippet):
+    # Add a script etc. at the start of the <body>, before every cell
+    # Only looked for after </head>: the injected head script mentions "<body>" in a comment
+    body_start = re.compile(r"<body\b[^>]*>").search(html, max(html.find("</head>"), 0))
+    if body_start is None:
+        return snippet + html
+    return html[:body_start.end()] + snippet + html[body_start.end():]
+
+def insert_before_body_end(html, snippet):
+    # Add a script etc. at the end of the <body>, after every cell
+    body_end = html.rfind("</body>")
+    if body_end < 0:
+        return html + snippet
+    return html[:body_end] + snippet + html[body_end:]
+
+
+# ===== Partial plotly.js bundles =====
+# plotly.js also comes as partial bundles holding only some trace types (a quarter to a third of the 4.5 MB full
+# bundle). With a directory of the prebuilt dist files (plotly-basic.min.js, plotly-cartesian.min.js, ... from the
+# plotly.js release or the plotly.js-<name>-dist-min npm packages), the trace types used by the page's figures pick
+# the smallest bundle covering all of them, of the same version as the bundle it replaces; otherwise the full one stays.
+# https://github.com/plotly/plotly.js/blob/master/dist/README.md#partial-bundles
+PLOTLY_PARTIAL_BUNDLES = { # Trace types of each partial bundle (plotly.js 2.x)
+    "basic": {"bar", "pie", "scatter"},
+    "cartesian": {"bar", "box", "contour", "heatmap", "histogram", "histogram2d", "histogram2dcontour", "image", "pie",
+                  "scatter", "scatterternary", "violin"},
+    "geo": {"choropleth", "scatter", "scattergeo"},
+    "gl3d": {"cone", "isosurface", "mesh3d", "scatter", "scatter3d", "streamtube", "surface", "volume"},
+    "gl2d": {"contourgl", "heatmapgl", "parcoords", "pointcloud", "scatter", "scattergl", "splom"},
+    "mapbox": {"choroplethmapbox", "densitymapbox", "scatter", "scattermapbox"},
+    "finance": {"bar", "candlestick", "funnel", "funnelarea", "histogram", "indicator", "ohlc", "pie", "scatter", "waterfall"}
+}
+
+def plotly_trace_types(html):
+    # Trace types used by the page's figures, None if a figure couldn't be read (its traces are unknown)
+    figures = [figure for _, _, figure in parse_plotly_figures(html)]
+    if len(figures) != len(PLOTLY_DIV_RE.findall(html)):
+        return None
+    return {trace.get("type", "scatter") for figure in figures for trace in figure["data"]} # scatter is plotly's default
+
+def find_plotly_bundle(bundle_dir, trace_types, version):
+    # Content of the smallest partial bundle in bundle_dir covering trace_types with the given version, else None
+    candidates = []
+    for name, supported in PLOTLY_PARTIAL_BUNDLES.items():
+        path = pathlib.Path(bundle_dir) / f"plotly-{name}.min.js"
+        if trace_types <= supported and path.is_file():
+            candidates.append((path.stat().st_size, path))
+    for _, path in sorted(candidates):
+        bundle = path.read_text(encoding = "utf-8").strip()
+        banner = PLOTLY_BANNER_RE.match(bundle)
+        if banner and banner.group(2) == version: # A different version could draw the figures differently
+            return bundle
+    return None
+
+def plotly_bundles_state(bundle_dir):
+    # Size and mtime of each partial bundle, so replacing one in bundle_dir invalidates the export cache
+    state = {}
+    for name in PLOTLY_PARTIAL_BUNDLES:
+        path = pathlib.Path(bundle_dir) / f"plotly-{name}.min.js"
+        if path.is_file():
+            stat = path.stat()
+            state[name] = [stat.st_size, stat.st_mtime_ns]
+    return state
+
+def select_plotly_bundle(html, bundle_dir):
+    # Swap the full plotly.js embedded in the page for the smallest partial bundle its figures need
+    trace_types = None
+
+    def swap(match, group):
+        nonlocal trace_types
+        banner = PLOTLY_BANNER_RE.match(match.group(group))
+        if banner.group(1): # Already a partial bundle
+            return match.group()
+        if trace_types is None:
+            trace_types = plotly_trace_types(html) or {"unknown"}
+        bundle = find_plotly_bundle(bundle_dir, trace_types, banner.group(2))
+        if bundle is None:
+            return match.group()
+        start, end = match.span(group)
+        return match.group()[:start - match.start()] + bundle + match.group()[end - match.start():]
+
+    html = PLOTLY_AMD_RE.sub(lambda match: swap(match, 1), html) # Notebook pages
+    return PLOTLY_SCRIPT_RE.sub(lambda match: swap(match, 2), html) # Standalone figure pages
+
+
+# ===== Virtualized DataFrame tables =====
+# pandas renders every displayed row as <tr><th>..</th><td>..</td>...</tr> markup. Large tables are turned into
+# column-oriented JSON (a fraction of the markup) plus their original <thead>; a small windowed renderer only
+# builds the rows visible in a scrollable box, and clicking a column header sorts by it.
+DATAFRAME_TABLE_RE = re.compile(r'<table border="1" class="dataframe">\s*(<thead>.*?</thead>)\s*<tbody>(.*?)</tbody>\s*</table>', re.S)
+TABLE_ROW_RE = re.compile(r"<tr\b[^>]*>(.*?)</tr>", re.S)
+TABLE_CELL_RE = re.compile(r"<(t[hd])\b([^>]*)>(.*?)</\1>", re.S)
+ROWSPAN_RE = re.compile(r'\browspan="(\d+)"')
+TAG_RE = re.compile(r"<[^>]+>")
+VIRTUAL_TABLE_HEIGHT = "500px" # Height of the scrollable box, about 20 rows
+VIRTUAL_TABLE_MIN_ROWS = 50 # Default number of rows from which a table is virtualized
+
+def dataframe_columns(tbody):
+    # Column-oriented cell texts of a pandas <tbody>, with the rowspans of a MultiIndex repeated on every row
+    # Returns (columns, index_columns) or None for tables this can't represent (colspan, ragged rows)
+    rows, spans = [], {} # spans: column -> [tag, text, rows still covered]
+    for row_html in TABLE_ROW_RE.findall(tbody):
+        row, cells = [], TABLE_CELL_RE.findall(row_html)
+        if len(cells) != row_html.count("<t"): # Cells this simple parser doesn't understand (nested tags etc.)
+            return None
+        for tag, attrs, content in cells:
+            if "colspan" in attrs:
+                return None
+            while len(row) in spans: # Filled by a rowspan from an earlier row
+                span = spans[len(row)]
+                row.append((span[0], span[1]))
+                span[2] -= 1
+                if span[2] == 0:
+                    del spans[len(row) - 1]
+            text = html_lib.unescape(TAG_RE.sub("", content)).strip()
+            rowspan = ROWSPAN_RE.search(attrs)
+            if rowspan and int(rowspan.group(1)) > 1:
+                spans[len(row)] = [tag, text, int(rowspan.group(1)) - 1]
+            row.append((tag, text))
+        while len(row) in spans: # Trailing spanned cells
+            span = spans[len(row)]
+            row.append((span[0], span[1]))
+            span[2] -= 1
+            if span[2] == 0:
+                del spans[len(row) - 1]
+        rows.append(row)
+    if not rows or any(len(row) != len(rows[0]) for row in rows):
+        return None
+    index_columns = next((i for i, (tag, _) in enumerate(rows[0]) if tag != "th"), len(rows[0])) # Leading <th> = index
+    return [list(column) for column in zip(*[[text for _, text in row] for row in rows])], index_columns
+
+def virtualize_tables(html, min_rows = VIRTUAL_TABLE_MIN_ROWS):
+    # Replace pandas tables of at least min_rows body rows with JSON + the windowed renderer
+    virtualized = 0
+
+    def replace_table(match):
+        nonlocal virtualized
+        thead, tbody = match.groups()
+        if tbody.count("<tr") < min_rows:
+            return match.group()
+        parsed = dataframe_columns(tbody)
+        if parsed is None:
+            return match.group()
+        columns, index_columns = parsed
+        virtualized += 1
+        data = script_json({"columns": columns, "index_columns": index_columns})
+        return (f'<div class="virtual-table"><div class="virtual-table-viewport" style="max-height: {VIRTUAL_TABLE_HEIGHT}; overflow: auto;">'
+                f'<table border="1" class="dataframe">{thead}<tbody></tbody></table></div>'
+                f'<script type="application/json" class="virtual-table-data">{data}</script></div>')
+
+    html = DATAFRAME_TABLE_RE.sub(replace_table, html)
+    return insert_before_body_end(html, virtual_table_script()) if virtualized else html
+
+def virtual_table_script():
+    # Windowed renderer of the virtual tables, with click-to-sort headers
+    return '''
+                <script>
+                // ===== Virtualized DataFrame tables =====
+                (() => { /* Arrow function called right away, keeps the variables out of the global scope */
+                  const OVERSCAN = 10; /* Extra rows built above and below the visible ones, so fast scrolling doesn't show gaps */
+                  function setup(container) {
+                    if (container.dataset.ready) return;
+                    container.dataset.ready = "1";
+                    let data = JSON.parse(container.querySelector("script.virtual-table-data").textContent);
+                    let columns = data.columns, rowCount = columns[0].length;
+                    let viewport = container.querySelector(".virtual-table-viewport");
+                    let tbody = container.querySelector("tbody");
+                    let order = Array.from({length: rowCount}, (_, i) => i); /* Row numbers in display order */
+                    let rowHeight = 0, sortColumn = -1, descending = false, pending = false;
+
+                    function render() {
+                      pending = false;
+                      let height = rowHeight || 24; /* Estimate until a row was measured */
+                      let first = Math.max(0, Math.floor(viewport.scrollTop / height) - OVERSCAN);
+                      let last = Math.min(rowCount, first + Math.ceil((viewport.clientHeight || 500) / height) + 2 * OVERSCAN);
+                      let rows = [];
+                      for (let r = first; r < last; r++) {
+                        let tr = document.createElement("tr");
+                        columns.forEach((column, c) => {
+                          let cell = document.createElement(c < data.index_columns ? "th" : "td"); /* Index cells are <th> like pandas */
+                          cell.textContent = column[order[r]]; /* Text, not HTML: the values were unescaped at export */
+                          tr.appendChild(cell);
+                        });
+                        rows.push(tr);
+                      }
+                      let top = document.createElement("tr"), bottom = document.createElement("tr"); /* Spacers keep the scrollbar right */
+                      top.style.height = first * height + "px";
+                      bottom.style.height = (rowCount - last) * height + "px";
+                      tbody.replaceChildren(top, ...rows, bottom);
+                      if (!rowHeight && rows.length) rowHeight = rows[0].getBoundingClientRect().height; /* 0 while hidden, measured later */
+                    }
+                    viewport.addEventListener("scroll", () => {
+                      if (!pending) { pending = true; requestAnimationFrame(render); } /* At most one render per frame */
+                    });
+
+                    function sortBy(c) {
+                      descending = sortColumn === c ? !descending : false; /* Second click on the same header reverses */
+                      sortColumn = c;
+                      let missing = v => v === "" || v === "NaN" || v === "NaT" || v === "None";
+                      let numeric = columns[c].every(v => missing(v) || isFinite(Number(v)));
+                      let column = columns[c];
+                      order.sort((a, b) => {
+                        if (missing(column[a]) || missing(column[b])) return missing(column[a]) - missing(column[b]); /* Missing values last */
+                        let result = numeric ? Number(column[a]) - Number(column[b]) : column[a].localeCompare(column[b], undefined, {numeric: true});
+                        return descending ? -result : result;
+                      });
+                      viewport.scrollTop = 0;
+                      render();
+                    }
+                    /* The column labels: the last header row with one cell per column and a label over the data columns
+                       (a named index adds a row below them holding only the index name) */
+                    let labelRows = Array.from(container.querySelectorAll("thead tr")).filter(tr => tr.cells.length === columns.length
+                      && Array.from(tr.cells).some((th, c) => c >= data.index_columns && th.textContent.trim()));
+                    if (labelRows.length) {
+                      Array.from(labelRows[labelRows.length - 1].cells).forEach((th, c) => {
+                        th.style.cursor = "pointer";
+                        th.title = "Sort";
+                        th.addEventListener("click", () => sortBy(c));
+                      });
+                    }
+                    render();
+                  }
+                  document.querySelectorAll(".virtual-table").forEach(setup);
+                  document.addEventListener("sectioninstantiated", event => { /* Tables of a collapsed-by-default section, once expanded */
+                    event.detail.querySelectorAll(".virtual-table").forEach(setup);
+                  });
+                })();
+                </script>
+                '''
+
+
+# ===== Compact single-file mode =====
+# A standalone page small enough to attach to an email: the finished HTML is gzip-compressed and embedded as base64
+# behind a small loader, which inflates it with the browser's own DecompressionStream and writes it into the
+# document, so every script in it (require.js, plotly, the injected collapsible-heading/toggle script) runs as usual.
+# https://developer.mozilla.org/en-US/docs/Web/API/DecompressionStream
+TITLE_RE = re.compile(r"<title>(.*?)</title>", re.S | re.I)
+
+def compact_single_file(html):
+    # Wrap the finished HTML in a self-decompressing page
+    payload = base64.b64encode(gzip.compress(html.encode("utf-8"), compresslevel = GZIP_LEVEL, mtime = 0)).decode("ascii")
+    title = TITLE_RE.search(html[:100000]) # The <title> is in the <head>, near the top
+    title = title.group(1) if title else "Notebook"
+    return f'''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+</head>
+<body>
+<p id="nb-loading" style="font-family: sans-serif; color: gray;">Loading notebook...</p>
+<script id="nb-payload" type="application/octet-stream">{payload}</script>
+<script>
+(async () => {{ /* async arrow function so the decompression can be awaited */
+  let status = document.getElementById("nb-loading");
+  if (typeof DecompressionStream === "undefined") {{ /* Chrome/Edge 80+, Firefox 113+, Safari 16.4+ */
+    status.textContent = "This browser cannot open compressed notebooks, please use a recent Chrome, Edge, Firefox or Safari.";
+    return;
+  }}
+  let binary = atob(document.getElementById("nb-payload").textContent); /* base64 -> binary string */
+  let bytes = new Uint8Array(binary.length); /* binary string -> bytes */
+  for (let i = 0; i < binary.length; i++) bytes[i] = binary.charCodeAt(i);
+  let stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream("gzip")); /* Inflate natively, in chunks */
+  let html = await new Response(stream).text(); /* Decode the inflated bytes as UTF-8 text */
+  document.open(); /* Replace this loader page with the notebook, its scripts run in order as they are written */
+  document.write(html);
+  document.close();
+}})();
+</script>
+</body>
+</html>
+'''
+
+
+# ===== Precompressed sidecars =====
+# Static servers can send <file>.gz / <file>.br as they are (e.g. nginx gzip_static / brotli_static) instead of
+# compressing 10-20 MB pages on every request. Sidecars are written for the exported pages and the site assets,
+# not for images, which are compressed already.
+PRECOMPRESS_SUFFIXES = {".html", ".js", ".css", ".json", ".svg"}
+GZIP_LEVEL = 9 # Written once and served many times, so use the smallest output
+BROTLI_QUALITY = 9 # 11 is smaller still but takes minutes on a 20 MB page
+
+@functools.lru_cache(maxsize = None)
+def sidecar_encoders():
+    # (sidecar suffix, compress function) for gzip and, when the brotli package is installed, brotli
+    # https://docs.python.org/3/library/gzip.html#gzip.compress, https://pypi.org/project/Brotli/
+    encoders = [(".gz", lambda data: gzip.compress(data, compresslevel = GZIP_LEVEL, mtime = 0))]
+    try:
+        import brotli
+    except ImportError: # Optional, gzip sidecars only
+        return encoders
+    encoders.append((".br", lambda data: brotli.compress(data, quality = BROTLI_QUALITY)))
+    return encoders
+
+def write_precompressed(path):
+    # Write the sidecars of one file unless they are newer than it already, returns the sidecars written
+    data, written = None, []
+    for suffix, compress in sidecar_encoders():
+        sidecar = path.with_name(path.name + suffix)
+        if sidecar.exists() and sidecar.stat().st_mtime_ns >= path.stat().st_mtime_ns: # Unchanged file (cache hit, shared asset)
+            continue
+        if data is None:
+            data = path.read_bytes()
+        tmp_file = sidecar.with_name(f"{sidecar.name}.{os.getpid()}.tmp") # Servers never see half a sidecar
+        tmp_file.write_bytes(compress(data))
+        os.replace(tmp_file, sidecar)
+        written.append(sidecar)
+    return written
+
+def precompress_export(html_file, site_dir = None):
+    # Sidecars for an exported page and, in site mode, for the shared assets it may have added
+    files = [pathlib.Path(html_file)]
+    if site_dir is not None:
+        assets_dir = pathlib.Path(site_dir).resolve() / SITE_ASSETS_DIR
+        if assets_dir.is_dir():
+            files.extend(sorted(path for path in assets_dir.iterdir() if path.suffix in PRECOMPRESS_SUFFIXES))
+    return [sidecar for path in files for sidecar in write_precompressed(path)]
+
+
+# ===== Output weight report and size budgets =====
+# --report breaks an exported page down by cell, output MIME type and output kind and lists the heaviest cells
+# with their heading path; budgets (total bytes, bytes per cell, DOM nodes) turn a bloated page into a failed export.
+# The report reads the written HTML file, so it works the same for fresh and "up to date" exports.
+OUTPUT_CHILD_RE = re.compile(r'<div class="jp-OutputArea-child[ "]') # One per output of a code cell
+MIME_TYPE_RE = re.compile(r'data-mime-type="([^"]+)"')
+IMAGE_SOURCE_RE = re.compile(r'<img\b[^>]*\ssrc="(?:data:(image/[\w.+-]+);|[^"]*(\.\w+)")') # Images carry no data-mime-type
+HEADING_TEXT_RE = re.compile(r"<h([1-6])\b[^>]*>(.*?)</h\1>", re.S)
+NON_DOM_RE = re.compile(r"<(script|style|template)\b[^>]*>.*?</\1>", re.S) # Contents that aren't DOM nodes (yet)
+ELEMENT_RE = re.compile(r"<[a-zA-Z]")
+COMPACT_PAYLOAD_RE = re.compile(r'<script id="nb-payload" type="application/octet-stream">([^<]*)</script>')
+
+def output_mime_type(output_html):
+    # MIME type of one rendered output (nbconvert's lab template marks stdout like text/plain results)
+    match = MIME_TYPE_RE.search(output_html)
+    if match is not None:
+        if match.group(1) == "text/plain" and "jp-OutputArea-executeResult" not in output_html[:100]:
+            return "application/vnd.jupyter.stdout"
+        return match.group(1)
+    image = IMAGE_SOURCE_RE.search(output_html)
+    if image is not None:
+        return image.group(1) or {extension: mime for mime, extension in IMAGE_EXTENSIONS.items()}.get(image.group(2), "image/*")
+    return "unknown"
+
+def output_kind(mime_type, output_html):
+    # Rough kind of one output, for the report
+    if "plotly-graph-div" in output_html:
+        return "plotly"
+    if "define('plotly'" in output_html or PLOTLY_BANNER_RE.search(output_html[:5000]):
+        return "plotly.js" # The library itself, once per notebook (shared in site mode)
+    if mime_type.startswith("image/") or "<img" in output_html:
+        return "image"
+    if 'class="dataframe"' in output_html:
+        return "table"
+    if mime_type in ("application/vnd.jupyter.stdout", "application/vnd.jupyter.stderr"):
+        return "stream"
+    return "html" if mime_type == "text/html" else "text"
+
+def heading_text(heading_html):
+    # Plain text of a heading, without its number span markup and nbconvert's "¶" anchor link
+    return html_lib.unescape(TAG_RE.sub("", heading_html)).replace("\u00b6", "").strip()
+
+def build_report(html):
+    # Weight of every cell and output of an exported page, plus its DOM node count
+    payload = COMPACT_PAYLOAD_RE.search(html)
+    if payload: # Compact single file: report on the page it unpacks to
+        html = gzip.decompress(base64.b64decode(payload.group(1))).decode("utf-8")
+    report = {"total_bytes": utf8_size(html), "dom_nodes": len(ELEMENT_RE.findall(NON_DOM_RE.sub("", html))),
+              "by_kind": collections.Counter(), "by_mime_type": collections.Counter(), "cells": []}
+    cell_starts = [m.start() for m in CELL_START_RE.finditer(html)]
+    if not cell_starts:
+        return report
+    cells_end = CELLS_END_RE.search(html, cell_starts[-1])
+    boundaries = cell_starts + [cells_end.start() if cells_end else len(html)]
+    heading_path = [] # (level, text) of the headings above the current cell
+
+    for number, (start, end) in enumerate(zip(boundaries, boundaries[1:]), start = 1):
+        cell = html[start:end]
+        cell_type = next((kind for kind in ("code", "markdown", "raw") if f"jp-{kind.capitalize()}Cell" in cell[:200]), "cell")
+        if cell_type == "markdown":
+            for match in HEADING_TEXT_RE.finditer(cell):
+                level = int(match.group(1))
+                heading_path = [(l, text) for l, text in heading_path if l < level] + [(level, heading_text(match.group(2)))]
+        outputs = []
+        output_starts = [m.start() for m in OUTPUT_CHILD_RE.finditer(cell)] + [len(cell)]
+        for output_start, output_end in zip(output_starts, output_starts[1:]):
+            output_html = cell[output_start:output_end]
+            mime_type = output_mime_type(output_html)
+            kind, size = output_kind(mime_type, output_html), utf8_size(output_html)
+            outputs.append({"mime_type": mime_type, "kind": kind, "bytes": size})
+            report["by_kind"][kind] += size
+            report["by_mime_type"][mime_type] += size
+        report["cells"].append({"number": number, "type": cell_type, "bytes": utf8_size(cell),
+                                "heading": " > ".join(text for _, text in heading_path), "outputs": outputs})
+    return report
+
+def format_bytes(size):
+    # 1234567 -> "1.2 MB"
+    for unit in ("B", "KB", "MB"):
+        if size < 1024 or unit == "MB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+def format_report(notebook_name, report, top = 10):
+    # Human-readable report: totals, bytes per kind and MIME type, heaviest cells
+    total = report["total_bytes"] or 1
+    def breakdown(counter):
+        return ", ".join(f"{name} {format_bytes(size)} ({size / total:.0%})" for name, size in counter.most_common())
+    lines = [f"Report for {notebook_name}: {format_bytes(report['total_bytes'])}, {report['dom_nodes']:,} DOM nodes at load",
+             f"  By output kind: {breakdown(report['by_kind']) or '-'}",
+             f"  By MIME type:   {breakdown(report['by_mime_type']) or '-'}",
+             f"  Heaviest cells:"]
+    for cell in sorted(report["cells"], key = lambda cell: cell["bytes"], reverse = True)[:top]:
+        kinds = collections.Counter()
+        for output in cell["outputs"]:
+            kinds[output["kind"]] += output["bytes"]
+        detail = ", ".join(f"{kind} {format_bytes(size)}" for kind, size in kinds.most_common())
+        lines.append(f"    #{cell['number']:<4} {cell['type']:<8} {format_bytes(cell['bytes']):>9}  {cell['heading'] or '(no heading)'}"
+                     + (f"  [{detail}]" if detail else ""))
+    return "\n".join(lines)
+
+def budget_violations(report, max_total_bytes = None, max_cell_bytes = None, max_dom_nodes = None):
+    # Messages for every budget the page exceeds (empty when it is within budget)
+    violations = []
+    if max_total_bytes and report["total_bytes"] > max_total_bytes:
+        violations.append(f"total size {format_bytes(report['total_bytes'])} > {format_bytes(max_total_bytes)}")
+    if max_cell_bytes:
+        violations.extend(f"cell #{cell['number']} ({cell['heading'] or 'no heading'}) {format_bytes(cell['bytes'])} > {format_bytes(max_cell_bytes)}"
+                          for cell in report["cells"] if cell["bytes"] > max_cell_bytes)
+    if max_dom_nodes and report["dom_nodes"] > max_dom_nodes:
+        violations.append(f"{report['dom_nodes']:,} DOM nodes > {max_dom_nodes:,}")
+    return violations
+
+def check_export(notebook_name, html_file, report = False, budgets = None):
+    # Print the report and/or check the budgets of an exported page, returns the budget violations
+    if not report and not any((budgets or {}).values()):
+        return []
+    weights = build_report(pathlib.Path(html_file).read_text(encoding = "utf-8"))
+    if report:
+        print(format_report(notebook_name, weights))
+    violations = budget_violations(weights, **(budgets or {}))
+    for violation in violations:
+        log("ERROR", f"Budget exceeded for {notebook_name}: {violation}")
+    return violations
+
+
+# ===== Export instrumentation =====
+# Each export phase (read, cache lookup, render, inject, write) is recorded as a span: a dict with its start time,
+# duration, input/output bytes and cell/output counts. Spans are collected per export and handed to a sink,
+# any callable taking one span dict, e.g. json_lines_sink() which writes one JSON object per line.
+
+@contextlib.contextmanager
+def trace_span(spans, notebook, phase):
+    # Time the with-block as one span appended to spans (nothing is recorded when spans is None)
+    # The block can add its own fields to the yielded dict, e.g. span["output_bytes"] = ...
+    fields = {}
+    start_time, started = datetime.now(), time.perf_counter()
+    try:
+        yield fields
+    finally:
+        if spans is not None:
+            spans.append({"notebook": str(notebook), "phase": phase,
+                          "start": start_time.isoformat(timespec = "milliseconds"),
+                          "duration_ms": round((time.perf_counter() - started) * 1000, 3), **fields})
+
+def utf8_size(text):
+    # Size of a str once written as UTF-8
+    return len(text.encode("utf-8"))
+
+def json_lines_sink(stream):
+    # Span sink writing one JSON object per line, e.g. json_lines_sink(sys.stderr) or an open log file
+    # https://jsonlines.org/
+    def sink(span):
+        stream.write(json.dumps(span) + "\n")
+        stream.flush()
+    return sink
+
+def notebook_counts(nb):
+    # Number of cells and outputs in a parsed notebook
+    return {"cells": len(nb.cells), "outputs": sum(len(cell.get("outputs", [])) for cell in nb.cells)}
+
+
+def read_notebook(notebook_bytes):
+    # Parse the notebook bytes into an nbformat node (v4)
+    # https://nbformat.readthedocs.io/en/latest/api.html#nbformat.reads
+    import nbformat
+    return nbformat.reads(notebook_bytes.decode("utf-8"), as_version = 4)
+
+def render_notebook(notebook, notebook_bytes, exporter, html_injection, coalesce_streams = True, nb = None):
+    # Convert phase: notebook bytes (or the already parsed nb) -> HTML string with the CSS + JS injection in <head>
+    if exporter is not None:
+        # Render in-process, with the same name/path resources the command line tool sets
+        # https://nbconvert.readthedocs.io/en/latest/api/exporters.html#nbconvert.exporters.Exporter.from_notebook_node
+        if nb is None:
+            nb = read_notebook(notebook_bytes)
+        resources = {
+            "metadata": {"name": notebook.stem, "path": str(notebook.parent)},
+            "html_injection": html_injection, # Rendered into <head> by INJECTION_TEMPLATE
+            "coalesce_streams": coalesce_streams # Read by coalesce_streams_preprocessor
+        }
+        body, _ = exporter.from_notebook_node(nb, resources = resources)
+        return body
+
+    # Fallback: run nbconvert and read the HTML from its standard output
+    # https://docs.python.org/3/library/subprocess.html#subprocess.run
+    body = subprocess.run(
+        ["jupyter", "nbconvert", "--to", "html", "--stdout", str(notebook)],
+        cwd = notebook.parent, # Run from the same directory as the notebook
+        check = True, # Raise CalledProcessError if command fails (non-zero exit code)
+        capture_output = True, encoding = "utf-8" # Capture logs in readable text format
+    ).stdout
+
+    # Inject into the HTML (the command line tool can't use our template, so patch its output afterwards)
+    return body.replace("</head>", html_injection + "</head>") # Replace the closing </head> tag with our injected CSS+JS + the </head> tag again
+
+PLOTLY_TRANSFORM_OPTIONS = {"lazy_plotly", "purge_plots", "share_plotly_templates", "plotly_bundle_dir", "typed_array_length",
+                            "float32_arrays", "downsample_points", "external_figures"}
+
+def transform_plotly(body, site_dir = None, lazy_plotly = False, purge_plots = False, share_plotly_templates = False,
+                     plotly_bundle_dir = None, typed_array_length = None, float32_arrays = False, downsample_points = None,
+                     external_figures = False):
+    # The Plotly part of transform_html(), also applied to HTML pages added to a site as they are
+    if plotly_bundle_dir:
+        body = select_plotly_bundle(body, plotly_bundle_dir) # Reads the figures, so before they are rewritten below
+
+    if lazy_plotly or purge_plots or share_plotly_templates or typed_array_length or downsample_points or external_figures:
+        # Figures drawn when scrolled near instead of all on load (fetched from their own JSON files in site mode),
+        # one copy of each layout template per page, oversized traces downsampled, numeric data as base64 typed arrays
+        if external_figures:
+            site_dir.mkdir(parents = True, exist_ok = True)
+        body = rewrite_plotly_figures(body, lazy = lazy_plotly or purge_plots or external_figures, purge = purge_plots,
+                                      share_templates = share_plotly_templates, typed_array_length = typed_array_length,
+                                      float32 = float32_arrays, downsample_points = downsample_points,
+                                      site_dir = site_dir if external_figures else None)
+    return body
+
+def transform_html(body, html_dir, site_dir = None, extract_images = False, lazy_plotly = False, purge_plots = False,
+                   share_plotly_templates = False, collapse_level = None, collapse_min_bytes = None, virtual_table_rows = None,
+                   plotly_bundle_dir = None, typed_array_length = None, float32_arrays = False, downsample_points = None,
+                   external_figures = False):
+    # Inject phase: export-time rewrites of the rendered HTML
+    # Line numbers for code cells, heading numbers and collapsible sections (previously built by JavaScript in the browser)
+    body = number_headings(number_code_lines(body))
+
+    body = transform_plotly(body, site_dir, lazy_plotly = lazy_plotly, purge_plots = purge_plots,
+                            share_plotly_templates = share_plotly_templates, plotly_bundle_dir = plotly_bundle_dir,
+                            typed_array_length = typed_array_length, float32_arrays = float32_arrays,
+                            downsample_points = downsample_points, external_figures = external_figures)
+
+    if virtual_table_rows:
+        body = virtualize_tables(body, virtual_table_rows) # Large DataFrames as JSON, only visible rows built
+
+    if collapse_level or collapse_min_bytes:
+        body = collapse_sections(body, collapse_level, collapse_min_bytes) # Contents built on first expand
+
+    if extract_images:
+        body = extract_inline_images(body, html_dir) # Images live next to the HTML file
+
+    if site_dir is not None:
+        site_dir.mkdir(parents = True, exist_ok = True)
+        body = externalize_site_assets(body, site_dir)
+
+    return body
+
+
+def build_html(notebook, notebook_bytes, exporter, html_injection, coalesce_streams = True, spans = None, notebook_name = None,
+               **transform_options):
+    # Parse, render and inject phases of an export: notebook bytes -> final HTML string (nothing written but assets)
+    # transform_options are passed on to transform_html (site_dir, extract_images, ...)
+    notebook_name = notebook_name or notebook.name
+    nb = None
+    if exporter is not None: # Parse up front so the span can report cell/output counts (the subprocess parses itself)
+        with trace_span(spans, notebook_name, "parse") as span:
+            nb = read_notebook(notebook_bytes)
+            span.update(input_bytes = len(notebook_bytes), **notebook_counts(nb))
+
+    with trace_span(spans, notebook_name, "render") as span:
+        body = render_notebook(notebook, notebook_bytes, exporter, html_injection, coalesce_streams = coalesce_streams, nb = nb)
+        if spans is not None:
+            span.update(engine = exporter_version(exporter), input_bytes = len(notebook_bytes), output_bytes = utf8_size(body))
+
+    with trace_span(spans, notebook_name, "inject") as span:
+        if spans is not None:
+            span["input_bytes"] = utf8_size(body)
+        body = transform_html(body, transform_options.get("site_dir") or notebook.parent, **transform_options)
+        if spans is not None:
+            span["output_bytes"] = utf8_size(body)
+    return body
+
+def _export_notebook(notebook_name, exporter = None, use_cache = True, site_dir = None, extract_images = False,
+                     coalesce_streams = True, compact = False, spans = None, cache_entries = None, **transform_options):
+    # Does the actual export, returns (html_file, status) where status is "completed" or "up to date"
+    # site_dir: write <site_dir>/<notebook>.html with shared assets instead of a timestamped file next to the notebook
+    # extract_images: write embedded images to <html dir>/images/ and lazy-load them
+    # coalesce_streams: merge stdout/stderr outputs, collapse progress bars and repeated warnings
+    #                   (in-process exporter only, the subprocess fallback renders streams as they are)
+    # compact: write a self-decompressing single file (gzip + base64 behind a small loader)
+    # spans: list that receives one timing span per export phase (None = no instrumentation)
+    # cache_entries: list that receives the (notebook, key, html_file) cache entry instead of writing the manifest here
+    #                (None = write it right away), so parallel exports leave the manifest to one process
+    # transform_options: further HTML rewrites passed on to transform_html (lazy_plotly, purge_plots, ...)
+    
+    # https://docs.python.org/3/library/pathlib.html
+
+    # Convert notebook to HTML
+    notebook = pathlib.Path(notebook_name).resolve() # Creates a path object, resolve() gets absolute path
+    if site_dir is not None:
+        site_dir = pathlib.Path(site_dir).resolve()
+    if compact and (site_dir is not None or extract_images): # Both write files next to the page
+        raise ValueError("A compact single file can't be combined with site mode or image extraction")
+    if transform_options.get("external_figures") and site_dir is None:
+        raise ValueError("Plotly figure files (--external-figures) need site mode (--site DIR)")
+
+    # Exported HTML pages (figures etc.) can join a site as they are, with the Plotly rewrites applied
+    # (the notebook-only options, image extraction, collapsed sections and virtual tables, don't apply to them)
+    if notebook.suffix.lower() == ".html":
+        if site_dir is None:
+            raise ValueError("HTML files can only be added in site mode (--site DIR)")
+        plotly_options = {name: value for name, value in transform_options.items() if name in PLOTLY_TRANSFORM_OPTIONS}
+        with trace_span(spans, notebook_name, "site_page"):
+            return add_html_page_to_site(notebook, site_dir, **plotly_options), "completed"
+
+    # Reuse the cached in-process exporter unless the caller passed one in
+    if exporter is None:
+        exporter = get_html_exporter()
+
+    # Read the notebook once: the same bytes are hashed for the cache and rendered below
+    with trace_span(spans, notebook_name, "read") as span:
+        notebook_bytes = notebook.read_bytes()
+        span["output_bytes"] = len(notebook_bytes)
+
+    # Skip the export entirely if neither the notebook, the exporter, the injected CSS/JS nor the options changed
+    with trace_span(spans, notebook_name, "cache_lookup") as span:
+        manifest_file = notebook.with_name(CACHE_MANIFEST_NAME)
+        options = {"site_dir": str(site_dir) if site_dir else None, "extract_images": extract_images,
+                   "coalesce_streams": coalesce_streams, "compact": compact, **transform_options}
+        if transform_options.get("plotly_bundle_dir"):
+            options["plotly_bundles"] = plotly_bundles_state(transform_options["plotly_bundle_dir"])
+        key = cache_key(notebook_bytes, exporter, build_html_injection(), options)
+        cached_html = lookup_cached_html(manifest_file, notebook, key) if use_cache else None
+        span["hit"] = cached_html is not None
+    if cached_html is not None:
+        return cached_html, "up to date"
+
+    # Timestamp for unique filenames
+    timestamp_str = datetime.now().strftime("%Y%m%d_%H%M%S")
+
+    # CSS + JS injection plus the footer timestamp for this export
+    html_injection = build_html_injection() + build_timestamp_footer()
+
+    body = build_html(notebook, notebook_bytes, exporter, html_injection, coalesce_streams = coalesce_streams, spans = spans,
+                      notebook_name = notebook_name, site_dir = site_dir, extract_images = extract_images, **transform_options)
+    if compact:
+        with trace_span(spans, notebook_name, "compact") as span:
+            if spans is not None:
+                span["input_bytes"] = utf8_size(body)
+            body = compact_single_file(body)
+            span["output_bytes"] = len(body) # ASCII only now
+
+    with trace_span(spans, notebook_name, "write") as span:
+        if site_dir is not None:
+            # Stable page name inside the site, so pages can link to each other
+            html_file = site_dir / f"{notebook.stem}.html"
+        else:
+            # Claim a collision-free timestamped output filename
+            html_file = reserve_html_file(notebook, timestamp_str)
+
+        html_file.write_text(body, encoding = "utf-8") # The only write: the HTML already contains the injection
+
+        # Remember this export so the next run can skip it if nothing changed
+        if cache_entries is None:
+            write_cache_entry(manifest_file, notebook, key, html_file)
+        else:
+            cache_entries.append((notebook, key, html_file))
+        span.update(output_bytes = html_file.stat().st_size, path = str(html_file))
+
+    return html_file, "completed"
+
+
+def export_notebook(notebook_name, exporter = None, use_cache = True, span_sink = None, precompress = False, report = False,
+                    budgets = None, **export_options):
+    # Export one notebook and return the path of its HTML file
+    # With use_cache = True an unchanged notebook returns its previous export without re-rendering
+    # span_sink: callable receiving one timing span dict per export phase, e.g. json_lines_sink(sys.stderr)
+    # precompress: also write <file>.gz (and <file>.br) next to the HTML file and the site assets
+    # report: print the weight of every cell/output, budgets: {"max_total_bytes", "max_cell_bytes", "max_dom_nodes"}
+    # (raises ValueError when the exported page exceeds a budget)
+    # export_options are passed on to _export_notebook (site_dir, ...)
+    spans = [] if span_sink is not None else None
+    html_file, status = _export_notebook(notebook_name, exporter = exporter, use_cache = use_cache, spans = spans,
+                                         **export_options)
+    for span in spans or []:
+        span_sink(span)
 
     # Print a timestamped log message showing which notebook was exported and the name of the generated HTML file
-    print(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")} [INFO] Export completed for {notebook_name} -> {html_file.name}')
+    log("INFO", f"Export {status} for {notebook_name} -> {html_file.name}")
+
+    violations = check_export(notebook_name, html_file, report = report, budgets = budgets)
+    if violations:
+        raise ValueError(f"{notebook_name} exceeds its size budget: {'; '.join(violations)}")
+
+    if precompress:
+        sidecars = precompress_export(html_file, export_options.get("site_dir"))
+        log("INFO", f"Precompressed {len(sidecars)} file(s) for {notebook_name}")
+
+    return html_file
+
+
+def _export_worker(notebook_name, trace = False, **export_options):
+    # Runs one export and never raises, so a failing notebook can't abort the rest of the batch
+    # Returns (notebook_name, html_file, status, error, spans, cache_entries) and lets the parent process do the logging
+    # in input order and the cache manifest writes (workers writing it themselves would drop each other's entries)
+    spans = [] if trace else None
+    cache_entries = []
+    try:
+        html_file, status = _export_notebook(notebook_name, spans = spans, cache_entries = cache_entries, **export_options)
+        return notebook_name, html_file, status, None, spans, cache_entries
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+        if isinstance(e, subprocess.CalledProcessError) and e.stderr: # Show nbconvert's own error message
+            error += "\n" + e.stderr.strip()
+        return notebook_name, None, None, error, spans, cache_entries
+
+
+def export_all_notebooks(notebooks, jobs = 1, span_sink = None, precompress = False, report = False, budgets = None,
+                         **export_options):
+    # jobs = 1 exports one notebook after another, jobs > 1 uses a pool of worker processes, jobs = 0 uses every CPU core
+    # span_sink: callable receiving the timing spans of every export (emitted by this process, in input order)
+    # precompress: write .gz/.br sidecars on a background thread while the next notebook renders
+    # report / budgets: see export_notebook(), a page over budget counts as a failed export
+    jobs = jobs or os.cpu_count() or 1
+    jobs = min(jobs, len(notebooks)) or 1 # No point starting more workers than notebooks
+    # Same options for every notebook (picklable for the pool)
+    worker = functools.partial(_export_worker, trace = span_sink is not None, **export_options)
+
+    if jobs == 1:
+        # Build the exporter once so every notebook in the batch reuses the same warm engine
+        get_html_exporter()
+        results = map(worker, notebooks)
+        executor = None
+    else:
+        # Each worker process builds its own exporter once (initializer) and reuses it for every notebook it receives
+        # https://docs.python.org/3/library/concurrent.futures.html#processpoolexecutor
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers = jobs, initializer = get_html_exporter)
+        results = executor.map(worker, notebooks) # map() yields results in input order, keeping the log deterministic
+
+    # One compression thread: zlib and brotli release the GIL, so it overlaps with the next render
+    # https://docs.python.org/3/library/concurrent.futures.html#threadpoolexecutor
+    compressor = concurrent.futures.ThreadPoolExecutor(max_workers = 1) if precompress else None
+    compressions = [] # (notebook_name, future) in input order
+    manifests = collections.defaultdict(list) # Cache manifest file -> [(notebook, key, html_file), ...]
+
+    failed = 0
+    try:
+        # Iterate through each result in the same order as the notebooks were given
+        for notebook_name, html_file, status, error, spans, cache_entries in results:
+            for span in spans or []:
+                span_sink(span)
+            for notebook, key, entry_html_file in cache_entries:
+                manifests[notebook.with_name(CACHE_MANIFEST_NAME)].append((notebook, key, entry_html_file))
+            if error is None:
+                log("INFO", f"Export {status} for {notebook_name} -> {html_file.name}")
+                if check_export(notebook_name, html_file, report = report, budgets = budgets):
+                    failed += 1
+                if compressor is not None:
+                    compressions.append((notebook_name,
+                                         compressor.submit(precompress_export, html_file, export_options.get("site_dir"))))
+            else:
+                failed += 1
+                log("ERROR", f"Export failed for {notebook_name}: {error}")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if compressor is not None:
+            compressor.shutdown() # Waits for the sidecars still being written
+        # Every export is done: write each manifest once (also after an interruption, for the exports that finished)
+        for manifest_file, entries in manifests.items():
+            write_cache_entries(manifest_file, entries)
+
+    for notebook_name, future in compressions:
+        try:
+            log("INFO", f"Precompressed {len(future.result())} file(s) for {notebook_name}")
+        except Exception as e:
+            failed += 1
+            log("ERROR", f"Precompress failed for {notebook_name}: {type(e).__name__}: {e}")
+
+    return failed # Number of notebooks that could not be exported
+
+
+# ===== Postprocess mode (streaming rewrite of existing exports) =====
+# Retrofits HTML files exported earlier (or by plain nbconvert) without re-running the notebooks:
+# the <head> injection is added or replaced by the current one, and code line numbers, heading numbers/sections
+# and (optionally) image extraction are applied cell by cell while the file is streamed in chunks.
+# Memory stays bounded by the <head> plus the largest single cell, whatever the size of the whole file.
+POSTPROCESS_CHUNK_SIZE = 1 << 20 # Characters read per chunk (1 MiB)
+STREAM_MARKER_OVERLAP = 32 # Characters kept between chunks so a marker split across two chunks is still found
+# An injection from an earlier export runs up to </head> from its marker comment, from the watermark CSS (exports
+# before the marker), or from the watermark stylesheet + script asset links (site pages before the marker)
+PREVIOUS_INJECTION_RE = re.compile(
+    r"(?:" + re.escape(INJECTION_MARKER) + r"|<style>\s*/\* ===== Watermark ===== \*/"
+    r'|<link rel="stylesheet" href="' + SITE_ASSETS_DIR + r'/style-[0-9a-f]+\.css">\s*'
+    r'<script src="' + SITE_ASSETS_DIR + r'/script-[0-9a-f]+\.js"></script>(?=.*<!-- ===== Floating buttons ===== -->)).*\Z', re.S)
+SITE_PAGE_RE = re.compile(r'<link rel="stylesheet" href="' + SITE_ASSETS_DIR + r'/style-[0-9a-f]+\.css">') # Head of a site page
+EXPORTED_ON_RE = re.compile(r"Exported on (\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})")
+CELLS_END_RE = re.compile(r"</main>|</body>") # Same end of the cell list number_headings() uses
+
+def postprocess_cell(cell, state, html_dir, extract_images = False):
+    # The per-cell part of transform_html(): code line numbers, heading numbers/sections, image extraction
+    cell = number_code_lines(cell) # Already numbered blocks (<pre class="line-numbered">) are left alone
+    if '<span class="heading-number">' not in cell: # Don't number a file exported with numbered headings twice
+        cell = number_cell_headings(cell, state)
+    if extract_images:
+        cell = extract_inline_images(cell, html_dir)
+    return cell
+
+def postprocess_stream(chunks, html_dir, extract_images = False):
+    # Rewrite an exported HTML document given as an iterator of text chunks, yields the output in pieces
+    chunks = iter(chunks)
+    buffer = ""
+
+    def read_more():
+        nonlocal buffer
+        chunk = next(chunks, "")
+        buffer += chunk
+        return bool(chunk)
 
+    # <head>: swap any earlier injection for the current one, keeping the original export time in the footer
+    while (head_end := buffer.find("</head>")) < 0:
+        if not read_more(): # Not a full HTML page, pass it through unchanged
+            yield buffer
+            return
+    head, buffer = buffer[:head_end], buffer[head_end:]
+    exported_at = None
+    previous = PREVIOUS_INJECTION_RE.search(head)
+    if previous is not None:
+        exported_on = EXPORTED_ON_RE.search(previous.group())
+        exported_at = exported_on.group(1) if exported_on else None
+        head = head[:previous.start()]
+    head += build_html_injection() + build_timestamp_footer(exported_at)
+    if SITE_PAGE_RE.search(head): # A site page: the injection goes to shared asset files again, like at export time
+        head = externalize_site_assets(head + "</head>", html_dir)[:-len("</head>")]
+    yield head
 
-def export_all_notebooks(notebooks):
-    # Iterate through each notebook filename in the provided list
-    for nb in notebooks:
-        # Call the export_notebook function for each notebook
-        export_notebook(nb)
+    # <body>: copy up to the first cell, rewrite cell by cell, then copy the rest
+    state = new_heading_state()
+    phase = "before cells"
+    scan = 0 # Where to resume searching for the next marker after more text was read
+    while True:
+        if phase == "before cells":
+            match = CELL_START_RE.search(buffer, scan)
+            if match is not None:
+                yield buffer[:match.start()]
+                buffer, scan, phase = buffer[match.start():], 1, "cells"
+                continue
+            keep = min(len(buffer), STREAM_MARKER_OVERLAP) # No cell yet: pass on everything but a possible partial marker
+            yield buffer[:len(buffer) - keep]
+            buffer, scan = buffer[len(buffer) - keep:], 0
+        elif phase == "cells":
+            # The current cell (at the start of the buffer) ends where the next cell or the cell list starts
+            ends = [match.start() for match in (CELL_START_RE.search(buffer, scan), CELLS_END_RE.search(buffer, scan)) if match]
+            if ends:
+                end = min(ends)
+                yield postprocess_cell(buffer[:end], state, html_dir, extract_images)
+                buffer, scan = buffer[end:], 1
+                if buffer.startswith("</"): # End of the cell list: close the sections still open
+                    yield "</div>" * len(state["open_sections"])
+                    phase = "after cells"
+                continue
+            scan = max(1, len(buffer) - STREAM_MARKER_OVERLAP) # The cell continues past this chunk
+        else:
+            yield buffer
+            buffer = ""
+
+        if not read_more():
+            break
+
+    if phase == "cells": # Truncated file: finish the last cell anyway
+        yield postprocess_cell(buffer, state, html_dir, extract_images) + "</div>" * len(state["open_sections"])
+    else:
+        yield buffer
+
+def postprocess_html(html_path, output = None, extract_images = False):
+    # Rewrite an exported HTML file with bounded memory; writes <stem>_post.html next to it unless output is given
+    # (output may be the input file itself, the result replaces it only once it is complete)
+    html_path = pathlib.Path(html_path).resolve()
+    output = pathlib.Path(output).resolve() if output else html_path.with_name(f"{html_path.stem}_post.html")
+    temporary = output.with_name(f".{output.name}.{os.getpid()}.tmp")
+    try:
+        # newline = "" keeps the line endings exactly as they are in the file
+        with open(html_path, encoding = "utf-8", newline = "") as source, \
+             open(temporary, "w", encoding = "utf-8", newline = "") as target:
+            chunks = iter(lambda: source.read(POSTPROCESS_CHUNK_SIZE), "") # Read until an empty string (end of file)
+            for part in postprocess_stream(chunks, output.parent, extract_images = extract_images):
+                target.write(part)
+        os.replace(temporary, output)
+    finally:
+        temporary.unlink(missing_ok = True)
+    return output
+
+def postprocess_all(html_files, output = None, extract_images = False):
+    # Postprocess every file, log each result, return the number of files that failed
+    failed = 0
+    for html_file in html_files:
+        try:
+            result = postprocess_html(html_file, output = output, extract_images = extract_images)
+            log("INFO", f"Postprocess completed for {html_file} -> {result.name}")
+        except Exception as e:
+            failed += 1
+            log("ERROR", f"Postprocess failed for {html_file}: {type(e).__name__}: {e}")
+    return failed
+
+
+# ===== Watch mode =====
+# --watch keeps one warm in-process exporter and re-exports a notebook whenever it is saved.
+# Changes come from inotify on Linux (through libc, no extra package needed) or from polling file stats elsewhere.
+# Jupyter autosaves can arrive as bursts of writes, so exports wait until the notebook has been quiet for a moment.
+WATCH_DEBOUNCE_SECONDS = 0.3 # Quiet time after the last change before exporting
+WATCH_POLL_SECONDS = 0.5 # Stat interval of the polling fallback
+IN_CLOSE_WRITE, IN_MOVED_TO = 0x00000008, 0x00000080 # From <sys/inotify.h>: file written and closed / renamed into place
+INOTIFY_EVENT = struct.Struct("iIII") # struct inotify_event header: wd, mask, cookie, len (then the file name)
+
+def watched_notebooks(paths):
+    # Notebook files to watch: files as given, directories contribute their *.ipynb files (checked again on each change)
+    notebooks = set()
+    for path in map(pathlib.Path, paths):
+        path = path.resolve()
+        notebooks.update(path.glob("*.ipynb") if path.is_dir() else [path])
+    return notebooks
+
+def inotify_waiter(directories):
+    # Returns wait(timeout) -> set of paths written in the directories, or None when inotify is not available
+    # https://man7.org/linux/man-pages/man7/inotify.7.html
+    import ctypes, ctypes.util
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno = True)
+        fd = libc.inotify_init1(os.O_CLOEXEC)
+    except (OSError, AttributeError): # Not Linux (no libc.so.6 / no inotify_init1)
+        return None
+    if fd < 0:
+        return None
+    watches = {}
+    for directory in directories:
+        wd = libc.inotify_add_watch(fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO)
+        if wd < 0: # E.g. the inotify watch limit is reached, polling still works
+            os.close(fd)
+            return None
+        watches[wd] = directory
+
+    def wait(timeout):
+        ready, _, _ = select.select([fd], [], [], timeout) # timeout = None waits for the next event
+        if not ready:
+            return set()
+        data, changed, offset = os.read(fd, 64 * 1024), set(), 0
+        while offset < len(data):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0") # The name is padded with NUL bytes
+            offset += length
+            if wd in watches and name:
+                changed.add(watches[wd] / os.fsdecode(name))
+        return changed
+    return wait
+
+def polling_waiter(paths, interval = WATCH_POLL_SECONDS):
+    # Returns wait(timeout) -> set of notebooks whose modification time or size changed since the last call
+    def snapshot():
+        stamps = {}
+        for notebook in watched_notebooks(paths):
+            try:
+                stat = notebook.stat()
+            except FileNotFoundError: # Deleted (or being replaced) between glob and stat
+                continue
+            stamps[notebook] = (stat.st_mtime_ns, stat.st_size)
+        return stamps
+
+    stamps = snapshot()
+    def wait(timeout):
+        nonlocal stamps
+        time.sleep(interval if timeout is None else min(timeout, interval))
+        current = snapshot()
+        changed = {notebook for notebook, stamp in current.items() if stamps.get(notebook) != stamp}
+        stamps = current
+        return changed
+    return wait
+
+def warm_exporter(exporter):
+    # Render an empty notebook once so the Jinja templates are loaded and compiled before the first save
+    if exporter is not None:
+        import nbformat
+        exporter.from_notebook_node(nbformat.v4.new_notebook())
+
+def watch_notebooks(paths, debounce = WATCH_DEBOUNCE_SECONDS, span_sink = None, **export_options):
+    # Export the notebooks once, then re-export each one when it is saved, until interrupted (Ctrl+C)
+    # paths: notebook files and/or directories (every *.ipynb in them, including new ones)
+    # export_options are passed on to export_all_notebooks (use_cache, site_dir, ...)
+    paths = [pathlib.Path(path).resolve() for path in paths]
+    directories = {path for path in paths if path.is_dir()}
+    files = {path for path in paths if not path.is_dir()}
+
+    def is_watched(path):
+        return path in files or (path.suffix == ".ipynb" and path.parent in directories)
+
+    wait = inotify_waiter(directories | {path.parent for path in files})
+    method = "inotify"
+    if wait is None:
+        wait, method = polling_waiter(paths), "polling"
+
+    warm_exporter(get_html_exporter()) # The warm exporter is reused for every re-export below
+    export_all_notebooks(sorted(map(str, watched_notebooks(paths))), span_sink = span_sink, **export_options)
+    log("INFO", f"Watching {len(paths)} path(s) for changes ({method}), press Ctrl+C to stop")
+
+    pending = set()
+    try:
+        while True:
+            # Block until something changes, then keep collecting changes until the directories are quiet:
+            # any event restarts the quiet period, also for files that aren't watched (an editor's temporary file
+            # written just before the notebook), only a wait that times out without events exports
+            events = wait(debounce if pending else None)
+            if events:
+                pending |= {path for path in events if is_watched(path)}
+                continue
+            if pending:
+                existing = sorted(str(path) for path in pending if path.exists()) # Skip notebooks deleted meanwhile
+                pending.clear()
+                if existing:
+                    export_all_notebooks(existing, span_sink = span_sink, **export_options)
+    except KeyboardInterrupt:
+        log("INFO", "Stopped watching")
+
+
+# ===== Preview server (serve subcommand) =====
+# Serves /<notebook>.html straight from the notebooks, rendered in memory on the first request.
+# Rendered pages are kept per notebook and only rebuilt when the notebook's content changes (mtime/size, then hash),
+# with an ETag so browsers revalidate with a cheap 304 and a gzip copy compressed once per render.
+SERVE_GZIP_LEVEL = 6 # Compression level for the cached gzip copy (1 = fastest, 9 = smallest)
+
+def find_preview_notebook(paths, name):
+    # Map a request path like "01_eda.html" to a watched notebook, None if there is no such notebook
+    if not name.endswith(".html") or "/" in name or "\\" in name: # Only plain page names, nothing outside the roots
+        return None
+    stem = name[:-len(".html")]
+    return next((notebook for notebook in sorted(watched_notebooks(paths)) if notebook.stem == stem), None)
+
+def preview_page(notebook, cache, lock, coalesce_streams = True):
+    # Cache entry {"stamp", "key", "etag", "body", "gzip"} for the notebook, rendered again only when its content changed
+    stat = notebook.stat()
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    with lock: # One render at a time: the shared exporter is not meant for concurrent use
+        entry = cache.get(notebook)
+        if entry is not None and entry["stamp"] == stamp:
+            return entry
+        exporter = get_html_exporter()
+        notebook_bytes = notebook.read_bytes()
+        key = cache_key(notebook_bytes, exporter, build_html_injection(), {"preview": True, "coalesce_streams": coalesce_streams})
+        if entry is None or entry["key"] != key: # Touched but unchanged notebooks keep their page
+            html_injection = build_html_injection() + build_timestamp_footer()
+            body = build_html(notebook, notebook_bytes, exporter, html_injection, coalesce_streams = coalesce_streams).encode("utf-8")
+            entry = {"key": key, "etag": f'W/"{key[:32]}"', "body": body,
+                     "gzip": gzip.compress(body, compresslevel = SERVE_GZIP_LEVEL, mtime = 0)}
+            log("INFO", f"Rendered {notebook.name} ({len(body)} bytes, {len(entry['gzip'])} gzipped)")
+        cache[notebook] = entry = dict(entry, stamp = stamp)
+        return entry
+
+def preview_index(paths):
+    # Small HTML page linking to every notebook that can be previewed
+    links = "".join(f'<li><a href="{urllib.parse.quote(notebook.stem)}.html">{notebook.stem}</a></li>'
+                    for notebook in sorted(watched_notebooks(paths)))
+    return f"<!DOCTYPE html><html><head><meta charset=\"utf-8\"><title>Notebooks</title></head><body><ul>{links}</ul></body></html>"
+
+def accepts_gzip(accept_encoding):
+    # Whether an Accept-Encoding header allows gzip: listed (or covered by "*") with a q-value above 0
+    # https://www.rfc-editor.org/rfc/rfc9110#section-12.5.3
+    qualities = {}
+    for item in accept_encoding.split(","):
+        coding, *parameters = [part.strip() for part in item.split(";")]
+        quality = 1.0
+        for parameter in parameters:
+            name, _, value = parameter.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0 # Malformed q-value, don't rely on it
+        if coding:
+            qualities[coding.lower()] = quality
+    quality = qualities.get("gzip", qualities.get("x-gzip", qualities.get("*", 0.0)))
+    return quality > 0
+
+class PreviewHandler(http.server.BaseHTTPRequestHandler):
+    # Request handler of serve_notebooks(), the server object carries the notebook paths and the page cache
+    # https://docs.python.org/3/library/http.server.html#http.server.BaseHTTPRequestHandler
+
+    def do_GET(self):
+        name = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path).lstrip("/")
+        if name in ("", "index.html"):
+            return self.send_page(200, {"Content-Type": "text/html; charset=utf-8", "Cache-Control": "no-cache"},
+                                  preview_index(self.server.notebook_paths).encode("utf-8"))
+        notebook = find_preview_notebook(self.server.notebook_paths, name)
+        if notebook is None:
+            return self.send_error(404, f"No notebook for {name}")
+        try:
+            entry = preview_page(notebook, self.server.page_cache, self.server.render_lock,
+                                 coalesce_streams = self.server.coalesce_streams)
+        except Exception as e:
+            log("ERROR", f"Export failed for {notebook.name}: {type(e).__name__}: {e}")
+            return self.send_error(500, f"Export failed for {notebook.name}")
+
+        # no-cache: the browser keeps the page but asks every time, which costs a 304 while the notebook is unchanged
+        headers = {"Content-Type": "text/html; charset=utf-8", "ETag": entry["etag"], "Cache-Control": "no-cache",
+                   "Vary": "Accept-Encoding"}
+        if_none_match = [tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")]
+        if entry["etag"] in if_none_match or "*" in if_none_match:
+            return self.send_page(304, headers, b"")
+        if accepts_gzip(self.headers.get("Accept-Encoding", "")):
+            headers["Content-Encoding"] = "gzip"
+            return self.send_page(200, headers, entry["gzip"])
+        return self.send_page(200, headers, entry["body"])
+
+    do_HEAD = do_GET # Same status and headers, send_page() leaves out the body
+
+    def send_page(self, status, headers, body):
+        self.send_response(status)
+        for header, value in headers.items():
+            self.send_header(header, value)
+        if status != 304:
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log("INFO", f"{self.address_string()} {format % args}") # Same log format as the exports
+
+def serve_notebooks(paths, host = "127.0.0.1", port = 8000, coalesce_streams = True):
+    # Serve previews of the notebooks in paths (files and/or directories) until interrupted (Ctrl+C)
+    server = http.server.ThreadingHTTPServer((host, port), PreviewHandler)
+    server.notebook_paths = [pathlib.Path(path).resolve() for path in paths]
+    server.page_cache, server.render_lock = {}, threading.Lock()
+    server.coalesce_streams = coalesce_streams
+    warm_exporter(get_html_exporter()) # Compile the templates before the first request comes in
+    log("INFO", f"Serving notebook previews on http://{host}:{server.server_port}/, press Ctrl+C to stop")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        log("INFO", "Stopped serving")
+    finally:
+        server.server_close()
 
 # Ensures the script only runs when executed directly, not when imported as a module into another Python script
 if __name__ == "__main__":
-    import sys
-    notebooks = sys.argv[1:]  # Accept multiple notebooks from command line 
-    if not notebooks: # Check if any notebooks not passed
+    if sys.argv[1:2] == ["serve"]: # Preview server subcommand, see serve_notebooks()
+        serve_parser = argparse.ArgumentParser(prog = "03_nb_exporter.py serve",
+                                               description = "Serve notebooks as HTML pages rendered on demand.")
+        serve_parser.add_argument("paths", nargs = "*", default = ["."],
+                                  help = "Notebook files or directories to serve (default: current directory)")
+        serve_parser.add_argument("--host", default = "127.0.0.1", help = "Address to listen on (default: 127.0.0.1)")
+        serve_parser.add_argument("--port", type = int, default = 8000, help = "Port to listen on (default: 8000)")
+        serve_parser.add_argument("--keep-streams", action = "store_true",
+                                  help = "Keep every stdout/stderr output as it is instead of merging them")
+        serve_args = serve_parser.parse_args(sys.argv[2:])
+        serve_notebooks(serve_args.paths, host = serve_args.host, port = serve_args.port,
+                        coalesce_streams = not serve_args.keep_streams)
+        sys.exit(0)
+
+    if sys.argv[1:2] == ["postprocess"]: # Streaming rewrite of existing HTML exports, see postprocess_html()
+        post_parser = argparse.ArgumentParser(prog = "03_nb_exporter.py postprocess",
+                                              description = "Add the watermark, line/heading numbers etc. to exported HTML files.")
+        post_parser.add_argument("html_files", nargs = "+", help = "Exported HTML files to rewrite")
+        post_output = post_parser.add_mutually_exclusive_group()
+        post_output.add_argument("-o", "--output", default = None,
+                                 help = "Output file (single input only, default: <name>_post.html next to the input)")
+        post_output.add_argument("--in-place", action = "store_true", help = "Replace each input file with its result")
+        post_parser.add_argument("--extract-images", action = "store_true",
+                                 help = "Write embedded images to images/<hash>.<ext> next to the output and lazy-load them")
+        post_args = post_parser.parse_args(sys.argv[2:])
+        if post_args.output and len(post_args.html_files) > 1:
+            post_parser.error("--output needs a single input file")
+        if post_args.in_place:
+            sys.exit(1 if sum(postprocess_all([html_file], output = html_file, extract_images = post_args.extract_images)
+                              for html_file in post_args.html_files) else 0)
+        sys.exit(1 if postprocess_all(post_args.html_files, output = post_args.output,
+                                      extract_images = post_args.extract_images) else 0)
+
+    # https://docs.python.org/3/library/argparse.html
+    parser = argparse.ArgumentParser(description = "Export Jupyter notebooks to watermarked, interactive HTML files.")
+    parser.add_argument("notebooks", nargs = "*", help = "Notebook files to export") # Accept multiple notebooks from command line
+    parser.add_argument("-j", "--jobs", type = int, default = 1, metavar = "N",
+                        help = "Export N notebooks in parallel (0 = one per CPU core, default: 1)")
+    parser.add_argument("--force", action = "store_true",
+                        help = "Re-export every notebook, even if it is unchanged since its last export")
+    parser.add_argument("--extract-images", action = "store_true",
+                        help = "Write embedded PNG/JPEG/GIF outputs to images/<hash>.<ext> next to the HTML and lazy-load them")
+    parser.add_argument("--keep-streams", action = "store_true",
+                        help = "Keep every stdout/stderr output as it is instead of merging them and collapsing progress bars")
+    parser.add_argument("--watch", action = "store_true",
+                        help = "Keep running and re-export a notebook each time it is saved (paths can be directories)")
+    parser.add_argument("--lazy-plotly", action = "store_true",
+                        help = "Draw Plotly figures when they are scrolled near instead of all while the page loads")
+    parser.add_argument("--purge-offscreen-plots", action = "store_true",
+                        help = "With lazy Plotly figures, also free figures far off-screen to cap memory (implies --lazy-plotly)")
+    parser.add_argument("--plotly-bundles", metavar = "DIR", default = None,
+                        help = "Directory of partial plotly.js bundles (plotly-basic.min.js, plotly-cartesian.min.js, ...): "
+                               "embed the smallest one covering the page's trace types instead of the full bundle")
+    parser.add_argument("--external-figures", action = "store_true",
+                        help = "Site mode: write each Plotly figure's data to its own JSON file, fetched when scrolled near")
+    parser.add_argument("--share-plotly-templates", action = "store_true",
+                        help = "Store identical Plotly layout templates once per page instead of once per figure")
+    parser.add_argument("--typed-arrays", action = "store_true",
+                        help = "Write long Plotly trace arrays as base64 typed arrays (needs plotly.js 2.28+)")
+    parser.add_argument("--typed-array-min-length", type = int, default = TYPED_ARRAY_MIN_LENGTH, metavar = "N",
+                        help = f"With --typed-arrays, arrays of at least N numbers are encoded (default {TYPED_ARRAY_MIN_LENGTH})")
+    parser.add_argument("--downsample-plotly", action = "store_true",
+                        help = "Downsample oversized Plotly scatter/line traces, noting the original point count on the figure")
+    parser.add_argument("--downsample-max-points", type = int, default = DOWNSAMPLE_POINTS, metavar = "N",
+                        help = f"With --downsample-plotly, traces of more than N points are downsampled to N (default {DOWNSAMPLE_POINTS})")
+    parser.add_argument("--float32", action = "store_true",
+                        help = "With --typed-arrays, store floating point arrays as 4-byte floats (about 7 significant digits)")
+    parser.add_argument("--collapse-level", type = int, default = None, metavar = "N", choices = range(1, 7),
+                        help = "Export sections of heading level N and deeper collapsed, built only when first expanded")
+    parser.add_argument("--collapse-min-kb", type = int, default = None, metavar = "KB",
+                        help = "Export sections of at least KB kilobytes collapsed, built only when first expanded")
+    parser.add_argument("--virtualize-tables", action = "store_true",
+                        help = "Store large DataFrame tables as JSON in a scrollable, sortable view")
+    parser.add_argument("--virtual-table-min-rows", type = int, default = VIRTUAL_TABLE_MIN_ROWS, metavar = "N",
+                        help = f"With --virtualize-tables, tables of at least N rows are virtualized (default {VIRTUAL_TABLE_MIN_ROWS})")
+    parser.add_argument("--compact-single-file", action = "store_true",
+                        help = "Write a self-decompressing single HTML file (gzip + base64), a fraction of the size, for email")
+    parser.add_argument("--precompress", action = "store_true",
+                        help = "Also write .gz (and .br if the brotli package is installed) files next to the HTML and site assets")
+    parser.add_argument("--report", action = "store_true",
+                        help = "Print the size of every cell by output kind and MIME type, the heaviest cells and the DOM node count")
+    parser.add_argument("--max-total-mb", type = float, default = None, metavar = "MB",
+                        help = "Fail (exit code 1) when an exported page is larger than MB megabytes")
+    parser.add_argument("--max-cell-mb", type = float, default = None, metavar = "MB",
+                        help = "Fail when a single cell of an exported page is larger than MB megabytes")
+    parser.add_argument("--max-dom-nodes", type = int, default = None, metavar = "N",
+                        help = "Fail when an exported page has more than N DOM nodes at load")
+    parser.add_argument("--log-json", metavar = "FILE", default = None,
+                        help = "Append per-phase timing spans as JSON lines to FILE (- for stderr)")
+    parser.add_argument("--site", metavar = "DIR", default = None,
+                        help = "Write <DIR>/<notebook>.html pages sharing plotly.js/CSS/JS files in <DIR>/assets "
+                               "(exported .html files such as figures can be passed too, the Plotly options apply to them)")
+    args = parser.parse_args()
+    if args.compact_single_file and (args.site or args.extract_images):
+        parser.error("--compact-single-file can't be combined with --site or --extract-images")
+    if args.jobs < 0:
+        parser.error("--jobs must be 0 (every CPU core) or more")
+    if args.downsample_max_points < 3: # LTTB keeps the first and last point plus at least one in between
+        parser.error("--downsample-max-points must be at least 3")
+    if args.virtual_table_min_rows < 1:
+        parser.error("--virtual-table-min-rows must be at least 1")
+    if args.typed_array_min_length < 1:
+        parser.error("--typed-array-min-length must be at least 1")
+    if args.collapse_min_kb is not None and args.collapse_min_kb < 1: # 0 would be ignored, a negative size collapses everything
+        parser.error("--collapse-min-kb must be at least 1")
+    if args.external_figures and not args.site:
+        parser.error("--external-figures needs --site DIR")
+
+    if not args.notebooks: # Check if any notebooks not passed
         # Print helpful usage instructions when no arguments are given
-        print("Usage: python notebook_exporter.py notebook1.ipynb notebook2.ipynb ...")
+        print("Usage: python 03_nb_exporter.py [--jobs N] [--force] [--site DIR] [--extract-images] [--keep-streams] [--lazy-plotly] [--purge-offscreen-plots] [--external-figures] [--share-plotly-templates] [--plotly-bundles DIR] [--typed-arrays] [--typed-array-min-length N] [--float32] [--downsample-plotly] [--downsample-max-points N] [--collapse-level N] [--collapse-min-kb KB] [--virtualize-tables] [--virtual-table-min-rows N] [--compact-single-file] [--report] [--max-total-mb MB] [--max-cell-mb MB] [--max-dom-nodes N] [--log-json FILE] [--precompress] [--watch] notebook1.ipynb notebook2.ipynb ...")
+        print("       python 03_nb_exporter.py serve [--host HOST] [--port PORT] [paths ...]")
+        print("       python 03_nb_exporter.py postprocess [-o OUTPUT | --in-place] [--extract-images] file1.html ...")
     else:
-        # Call the batch export function with the provided list of notebooks
-        export_all_notebooks(notebooks)
\ No newline at end of file
+        with contextlib.ExitStack() as stack: # Closes the log file (if any) when the batch is done
+            span_sink = None
+            if args.log_json == "-":
+                span_sink = json_lines_sink(sys.stderr)
+            elif args.log_json:
+                span_sink = json_lines_sink(stack.enter_context(open(args.log_json, "a", encoding = "utf-8")))
+
+            export_options = dict(use_cache = not args.force, site_dir = args.site, extract_images = args.extract_images,
+                                  coalesce_streams = not args.keep_streams, compact = args.compact_single_file,
+                                  lazy_plotly = args.lazy_plotly, purge_plots = args.purge_offscreen_plots,
+                                  share_plotly_templates = args.share_plotly_templates,
+                                  plotly_bundle_dir = str(pathlib.Path(args.plotly_bundles).resolve()) if args.plotly_bundles else None,
+                                  typed_array_length = args.typed_array_min_length if args.typed_arrays else None,
+                                  float32_arrays = args.float32,
+                                  downsample_points = args.downsample_max_points if args.downsample_plotly else None,
+                                  external_figures = args.external_figures,
+                                  collapse_level = args.collapse_level,
+                                  collapse_min_bytes = args.collapse_min_kb * 1024 if args.collapse_min_kb else None,
+                                  virtual_table_rows = args.virtual_table_min_rows if args.virtualize_tables else None,
+                                  span_sink = span_sink, precompress = args.precompress, report = args.report,
+                                  budgets = {"max_total_bytes": int(args.max_total_mb * 1024 * 1024) if args.max_total_mb else None,
+                                             "max_cell_bytes": int(args.max_cell_mb * 1024 * 1024) if args.max_cell_mb else None,
+                                             "max_dom_nodes": args.max_dom_nodes})
+            if args.watch:
+                watch_notebooks(args.notebooks, **export_options) # Runs until Ctrl+C
+                failed = 0
+            else:
+                # Call the batch export function with the provided list of notebooks, exit non-zero if any export failed
+                failed = export_all_notebooks(args.notebooks, jobs = args.jobs, **export_options)
+        sys.exit(1 if failed else 0)
\ No newline at end of file
@@ -0,0 +1,360 @@
+"""
+ Script Metadata
+
+- Script Name: 04_nb_export_bench.py
+- Title: MoneyLion DS Assessment
+- Author: Khoon Ching Wong
+- Created: 2026-10-18
+- Last Modified: 2026-10-18
+- Repository Link: https://github.com/wongkhoon/DS-Assessment/tree/main/MoneyLion/src
+
+Description:
+  What this script does:
+ - Generates synthetic notebooks (code/markdown cells, headings, stream outputs, PNGs, Plotly figures, DataFrame tables)
+   from small up to the size of our ~20 MB 02_model export
+ - Exports each one with the same pipeline as 03_nb_exporter.py, in a fresh process per run
+ - Measures every export phase (read, convert, inject, write): wall time, memory and output bytes.
+   Memory per phase is how far the phase raised the process's peak RSS (ru_maxrss only ever grows, so a phase
+   needing less than an earlier one shows 0) and, with --trace-memory, the phase's own peak of Python allocations
+   above what was allocated when it started (tracemalloc, which slows the run down)
+ - Saves the results as JSON and can compare them with an earlier run to spot regressions
+
+  How to run this script:
+       python 04_nb_export_bench.py                                  # all presets, results in nb_export_bench.json
+       python 04_nb_export_bench.py --preset small medium --repeat 5
+       python 04_nb_export_bench.py --preset large --extract-images --output after.json --compare before.json
+       python 04_nb_export_bench.py --preset small --plotly-figures 50 --plotly-points 100000
+       python 04_nb_export_bench.py --preset large --repeat 1 --trace-memory
+
+Presets:
+    small   a quick smoke test (well under 1 MB)
+    medium  shaped like 01_eda (about 9 MB)
+    large   shaped like 02_model (about 20 MB, hundreds of stderr outputs and big figures)
+
+"""
+
+import argparse # For parsing command line options
+import base64 # For embedding generated PNGs in the notebook
+import concurrent.futures # For running each export in a fresh process
+import importlib.util # For loading 03_nb_exporter.py (its name starts with a digit, so it can't be imported normally)
+import json # For the results file and the Plotly figure specs
+import multiprocessing # For the "spawn" start method (a clean interpreter per run)
+import pathlib # For handling file system paths
+import platform # For recording where the benchmark ran
+import random # For reproducible synthetic data
+import statistics # For the median over repeated runs
+import struct # For writing PNG chunks
+import sys # For the platform check in peak_rss_mb()
+import tempfile # For the scratch directory holding the synthetic notebooks
+import time # For wall-clock timing
+import tracemalloc # For the per-phase peak of Python allocations (--trace-memory)
+import zlib # For PNG compression and checksums
+from datetime import datetime # For timestamping the results
+
+# Everything the generator can vary, per preset
+PRESETS = {
+    "small": {
+        "code_cells": 20, "markdown_cells": 10, "headings": 6, "stream_outputs": 10, "pngs": 2, "png_kb": 20,
+        "plotly_figures": 2, "plotly_points": 200, "tables": 2, "table_rows": 20, "plotly_bundle_kb": 500,
+    },
+    "medium": { # Shaped like 01_eda: 187 cells, 9 PNGs, 17 figures, 31 tables
+        "code_cells": 102, "markdown_cells": 85, "headings": 40, "stream_outputs": 20, "pngs": 9, "png_kb": 60,
+        "plotly_figures": 17, "plotly_points": 5000, "tables": 31, "table_rows": 100, "plotly_bundle_kb": 4500,
+    },
+    "large": { # Shaped like 02_model: 440 stderr outputs, 19 figures with large arrays
+        "code_cells": 120, "markdown_cells": 60, "headings": 30, "stream_outputs": 880, "pngs": 20, "png_kb": 80,
+        "plotly_figures": 19, "plotly_points": 40000, "tables": 10, "table_rows": 50, "plotly_bundle_kb": 4500,
+    },
+}
+
+
+def load_exporter():
+    # Import 03_nb_exporter.py from this directory by file path
+    # https://docs.python.org/3/library/importlib.html#importing-a-source-file-directly
+    path = pathlib.Path(__file__).resolve().with_name("03_nb_exporter.py")
+    spec = importlib.util.spec_from_file_location("nb_exporter", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# ===== Synthetic notebook generator =====
+
+def make_png(rng, kilobytes):
+    # A valid RGB PNG of random pixels, about `kilobytes` in size (noise doesn't compress)
+    # https://www.w3.org/TR/png/#5Chunk-layout
+    width = 256
+    height = max(1, kilobytes * 1024 // (width * 3))
+    raw = b"".join(b"\x00" + rng.randbytes(width * 3) for _ in range(height)) # Filter byte 0 + one row of pixels
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw, 1)) + chunk(b"IEND", b""))
+
+def make_plotly_template():
+    # Stand-in for plotly's default layout.template: per-trace-type defaults repeated in every figure
+    trace_types = ["bar", "barpolar", "box", "candlestick", "carpet", "choropleth", "contour", "contourcarpet",
+                   "heatmap", "heatmapgl", "histogram", "histogram2d", "histogram2dcontour", "icicle", "mesh3d",
+                   "parcoords", "pie", "scatter", "scatter3d", "scattercarpet", "scattergeo", "scattergl",
+                   "scattermapbox", "scatterpolar", "scatterpolargl", "scatterternary", "surface", "table"]
+    colorscale = [[i / 9, f"#{i * 25:02x}08{255 - i * 25:02x}"] for i in range(10)]
+    return {
+        "data": {t: [{"type": t, "colorbar": {"outlinewidth": 0, "ticks": ""}, "colorscale": colorscale}] for t in trace_types},
+        "layout": {"font": {"color": "#2a3f5f"}, "hovermode": "closest", "paper_bgcolor": "white",
+                   "colorway": ["#636efa", "#EF553B", "#00cc96", "#ab63fa", "#FFA15A"]},
+    }
+
+def make_plotly_bundle_output(kilobytes):
+    # Stand-in for the plotly.js bundle the "notebook" renderer embeds once per notebook (same RequireJS wrapper)
+    filler = "var _=" + "0" * (kilobytes * 1024) + ";"
+    return ("<script type=\"text/javascript\">\n        window.PlotlyConfig = {MathJaxConfig: 'local'};\n"
+            "        if (typeof require !== 'undefined') {\n        require.undef(\"plotly\");\n"
+            "        define('plotly', function(require, exports, module) {\n            /**\n* plotly.js v2.35.2\n*/\n"
+            f"{filler}\n        }});\n        require(['plotly'], function(Plotly) {{\n            window._Plotly = Plotly;\n"
+            "        });\n        }\n        </script>")
+
+def make_plotly_output(rng, index, points, template):
+    # text/html output shaped like plotly.py's notebook renderer: a div plus a Plotly.newPlot call
+    data = [{"type": "scatter", "mode": "lines", "x": list(range(points)),
+             "y": [round(rng.gauss(0, 1), 6) for _ in range(points)]}]
+    layout = {"template": template, "title": {"text": f"Figure {index}"}}
+    div_id = f"bench-figure-{index}"
+    return (f'<div> <div class="plotly-graph-div" id="{div_id}" style="height:525px; width:100%;"></div> '
+            f'<script type="text/javascript"> require(["plotly"], function(Plotly) {{ window.PLOTLYENV=window.PLOTLYENV || {{}}; '
+            f'if (document.getElementById("{div_id}")) {{ Plotly.newPlot( "{div_id}", {json.dumps(data)}, '
+            f'{json.dumps(layout)}, {{"responsive": true}} ) }}; }}); </script> </div>')
+
+def make_table_output(rng, rows):
+    # text/html output shaped like a pandas DataFrame
+    columns = ["loanId", "apr", "loanAmount", "state", "leadType"]
+    head = "".join(f"<th>{c}</th>" for c in columns)
+    body = "".join(
+        f"<tr><th>{r}</th><td>LL-I-{rng.randrange(10**8):08d}</td><td>{rng.uniform(100, 700):.1f}</td>"
+        f"<td>{rng.randrange(100, 3000)}.0</td><td>IL</td><td>bvMandatory</td></tr>\n" for r in range(rows))
+    return (f'<div><table border="1" class="dataframe"><thead><tr style="text-align: right;"><th></th>{head}</tr></thead>'
+            f"<tbody>\n{body}</tbody></table></div>")
+
+def make_stream_output(rng, index):
+    # Alternates tqdm-style progress redraws on stderr with LightGBM-style log lines on stdout
+    if index % 2 == 0:
+        percent = index % 101
+        return {"output_type": "stream", "name": "stderr",
+                "text": f"\rOptimization Progress: {percent:3d}%|{'#' * (percent // 10):<10}| {percent}/100 [00:{index % 60:02d}<?, ?it/s]"}
+    lines = ["[LightGBM] [Warning] No further splits with positive gain, best gain: -inf",
+             f"[LightGBM] [Debug] Trained a tree with leaves = {rng.randrange(30, 50)} and depth = {rng.randrange(8, 16)}"]
+    return {"output_type": "stream", "name": "stdout", "text": "\n".join(lines) + "\n"}
+
+def generate_notebook(params, seed = 0):
+    # Build the synthetic notebook as a plain nbformat v4 dict
+    # https://nbformat.readthedocs.io/en/latest/format_description.html
+    rng = random.Random(seed) # Same parameters and seed, same notebook
+    template = make_plotly_template()
+
+    # Outputs are dealt round-robin over the code cells
+    outputs = []
+    outputs += [make_stream_output(rng, i) for i in range(params["stream_outputs"])]
+    outputs += [{"output_type": "display_data", "metadata": {},
+                 "data": {"image/png": base64.b64encode(make_png(rng, params["png_kb"])).decode(), "text/plain": "<Figure>"}}
+                for _ in range(params["pngs"])]
+    outputs += [{"output_type": "display_data", "metadata": {},
+                 "data": {"text/html": make_plotly_output(rng, i, params["plotly_points"], template)}}
+                for i in range(params["plotly_figures"])]
+    outputs += [{"output_type": "execute_result", "execution_count": 1, "metadata": {},
+                 "data": {"text/html": make_table_output(rng, params["table_rows"]), "text/plain": "DataFrame"}}
+                for _ in range(params["tables"])]
+    code_outputs = [[] for _ in range(max(1, params["code_cells"]))]
+    for i, output in enumerate(outputs):
+        code_outputs[i % len(code_outputs)].append(output)
+    if params["plotly_figures"] and params["plotly_bundle_kb"]:
+        code_outputs[0].insert(0, {"output_type": "display_data", "metadata": {},
+                                   "data": {"text/html": make_plotly_bundle_output(params["plotly_bundle_kb"])}})
+
+    code_source = "\n".join([
+        "import pandas as pd",
+        "df = pd.read_csv(\"loan.csv\")  # load data",
+        "for column in df.columns:",
+        "    print(column, df[column].isna().mean())",
+        "\"\"\"multi-line",
+        "string\"\"\"",
+    ])
+    cells = []
+    markdown_left, headings_left = params["markdown_cells"], params["headings"]
+    for i, cell_outputs in enumerate(code_outputs):
+        if markdown_left: # Spread the markdown cells between the code cells
+            for _ in range(-(-markdown_left // (len(code_outputs) - i))): # Ceiling division
+                if headings_left:
+                    level = (1, 2, 2, 3)[headings_left % 4]
+                    source = f"{'#' * level} Section {headings_left}\nSome explanation of the analysis below."
+                    headings_left -= 1
+                else:
+                    source = "Notes on the **results** above, with `inline code` and a [link](https://example.com)."
+                cells.append({"cell_type": "markdown", "metadata": {}, "source": source})
+                markdown_left -= 1
+        cells.append({"cell_type": "code", "execution_count": i + 1, "metadata": {}, "source": code_source,
+                      "outputs": cell_outputs})
+    for i, cell in enumerate(cells):
+        cell["id"] = f"cell-{i}"
+
+    return {"nbformat": 4, "nbformat_minor": 5, "cells": cells,
+            "metadata": {"kernelspec": {"name": "python3", "display_name": "Python 3", "language": "python"},
+                         "language_info": {"name": "python"}}}
+
+
+# ===== Measurement =====
+
+def peak_rss_mb():
+    # Process high-water mark of resident memory, None where the resource module doesn't exist (Windows)
+    # https://docs.python.org/3/library/resource.html#resource.getrusage
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1) # Bytes on macOS, kilobytes on Linux
+
+def run_export(notebook_path, export_options, trace_memory = False):
+    # One export, phase by phase, in the calling process (run_case() gives it a fresh process)
+    exporter_module = load_exporter()
+    notebook = pathlib.Path(notebook_path)
+    out_dir = notebook.with_name(f"{notebook.stem}_out")
+    site_dir = out_dir / "site" if export_options.get("site") else None
+    phases = {}
+    previous_peak = peak_rss_mb() # Process peak before the phase
+    if trace_memory:
+        tracemalloc.start()
+    allocated = 0 # Python allocations when the phase started
+
+    def record(name, started, output_bytes):
+        # Time, memory and output size of the phase that just ended; the next phase starts from here
+        nonlocal previous_peak, allocated
+        seconds = time.perf_counter() - started
+        peak = peak_rss_mb()
+        python_peak = None
+        if trace_memory:
+            current, traced_peak = tracemalloc.get_traced_memory()
+            python_peak = round((traced_peak - allocated) / (1024 * 1024), 1)
+            tracemalloc.reset_peak() # https://docs.python.org/3/library/tracemalloc.html#tracemalloc.reset_peak
+            allocated = current
+        phases[name] = {"seconds": seconds, "output_bytes": output_bytes,
+                        "rss_growth_mb": round(peak - previous_peak, 1) if peak is not None else None,
+                        "python_peak_mb": python_peak,
+                        "process_peak_rss_mb": peak} # Cumulative: the whole run up to the end of this phase
+        previous_peak = peak
+
+    started = time.perf_counter()
+    exporter = exporter_module.get_html_exporter() # Startup: imports and exporter construction
+    record("startup", started, 0)
+
+    started = time.perf_counter()
+    notebook_bytes = notebook.read_bytes()
+    record("read", started, len(notebook_bytes))
+
+    started = time.perf_counter()
+    html_injection = exporter_module.build_html_injection() + exporter_module.build_timestamp_footer()
+    body = exporter_module.render_notebook(notebook, notebook_bytes, exporter, html_injection,
+                                           coalesce_streams = export_options.get("coalesce_streams", True))
+    record("convert", started, len(body.encode("utf-8")))
+
+    started = time.perf_counter()
+    out_dir.mkdir(exist_ok = True)
+    body = exporter_module.transform_html(body, site_dir or out_dir, site_dir = site_dir,
+                                          extract_images = export_options.get("extract_images", False))
+    record("inject", started, len(body.encode("utf-8")))
+
+    started = time.perf_counter()
+    html_file = (site_dir or out_dir) / f"{notebook.stem}.html"
+    html_file.write_text(body, encoding = "utf-8")
+    record("write", started, html_file.stat().st_size)
+
+    return phases
+
+def run_case(notebook_path, export_options, trace_memory = False):
+    # Run one export in a freshly spawned interpreter so timings and memory aren't affected by earlier runs
+    # https://docs.python.org/3/library/multiprocessing.html#contexts-and-start-methods
+    with concurrent.futures.ProcessPoolExecutor(max_workers = 1, mp_context = multiprocessing.get_context("spawn")) as pool:
+        return pool.submit(run_export, str(notebook_path), export_options, trace_memory).result()
+
+def summarize(runs):
+    # Median wall time, largest memory figures and output bytes per phase over the repeated runs
+    def largest(phase, key):
+        values = [run[phase][key] for run in runs if run[phase][key] is not None]
+        return max(values) if values else None
+
+    return {
+        phase: {
+            "seconds_median": statistics.median(run[phase]["seconds"] for run in runs),
+            "seconds_min": min(run[phase]["seconds"] for run in runs),
+            "rss_growth_mb": largest(phase, "rss_growth_mb"),
+            "python_peak_mb": largest(phase, "python_peak_mb"),
+            "process_peak_rss_mb": largest(phase, "process_peak_rss_mb"),
+            "output_bytes": runs[-1][phase]["output_bytes"],
+        }
+        for phase in runs[0]
+    }
+
+def compare(results, baseline):
+    # Print median time ratios against an earlier results file (> 1.00x means slower now)
+    previous = {case["name"]: case["summary"] for case in baseline.get("cases", [])}
+    for case in results["cases"]:
+        if case["name"] not in previous:
+            continue
+        for phase, now in case["summary"].items():
+            before = previous[case["name"]].get(phase)
+            if before and before["seconds_median"] > 0:
+                ratio = now["seconds_median"] / before["seconds_median"]
+                flag = "  <-- slower" if ratio > 1.10 else ""
+                print(f'{case["name"]:>8} {phase:>8}: {before["seconds_median"]:8.3f}s -> {now["seconds_median"]:8.3f}s '
+                      f'({ratio:.2f}x){flag}')
+
+
+# Ensures the script only runs when executed directly (and not again in the spawned worker processes)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmark the notebook export pipeline on synthetic notebooks.")
+    parser.add_argument("--preset", nargs = "+", choices = sorted(PRESETS), default = ["small", "medium", "large"],
+                        help = "Notebook sizes to benchmark (default: all)")
+    for key in PRESETS["small"]: # --code-cells N, --plotly-points N, ... override the preset values
+        parser.add_argument(f"--{key.replace('_', '-')}", type = int, default = None, metavar = "N")
+    parser.add_argument("--repeat", type = int, default = 3, help = "Runs per preset (default: 3)")
+    parser.add_argument("--extract-images", action = "store_true", help = "Benchmark with image extraction")
+    parser.add_argument("--keep-streams", action = "store_true", help = "Benchmark without stream coalescing")
+    parser.add_argument("--site", action = "store_true", help = "Benchmark site mode (shared assets)")
+    parser.add_argument("--output", default = "nb_export_bench.json", help = "Results file (default: nb_export_bench.json)")
+    parser.add_argument("--compare", metavar = "JSON", default = None, help = "Earlier results file to compare against")
+    parser.add_argument("--trace-memory", action = "store_true",
+                        help = "Also record each phase's peak of Python allocations (tracemalloc, makes the timings slower)")
+    args = parser.parse_args()
+
+    export_options = {"extract_images": args.extract_images, "coalesce_streams": not args.keep_streams, "site": args.site}
+    results = {
+        "created": datetime.now().isoformat(timespec = "seconds"),
+        "python": platform.python_version(), "platform": platform.platform(),
+        "export_options": export_options, "repeat": args.repeat, "trace_memory": args.trace_memory, "cases": [],
+    }
+
+    with tempfile.TemporaryDirectory(prefix = "nb_export_bench_") as work_dir:
+        for name in args.preset:
+            params = dict(PRESETS[name])
+            params.update({key: getattr(args, key) for key in params if getattr(args, key) is not None})
+            notebook_path = pathlib.Path(work_dir) / f"{name}.ipynb"
+            notebook_path.write_text(json.dumps(generate_notebook(params)), encoding = "utf-8")
+
+            runs = [run_case(notebook_path, export_options, args.trace_memory) for _ in range(args.repeat)]
+            summary = summarize(runs)
+            results["cases"].append({"name": name, "params": params, "notebook_bytes": notebook_path.stat().st_size,
+                                     "summary": summary, "runs": runs})
+
+            # One line per phase, e.g. "   large  convert:    3.214s   +312.3 MB RSS  (412.3 MB process peak)   19,812,345 bytes"
+            # (plus the phase's Python allocation peak with --trace-memory)
+            for phase, stats in summary.items():
+                rss = f'{stats["rss_growth_mb"]:+8.1f} MB RSS' if stats["rss_growth_mb"] is not None else "     n/a RSS"
+                if stats["python_peak_mb"] is not None:
+                    rss += f' {stats["python_peak_mb"]:8.1f} MB Python peak'
+                if stats["process_peak_rss_mb"] is not None:
+                    rss += f' ({stats["process_peak_rss_mb"]:.1f} MB process peak)'
+                print(f'{name:>8} {phase:>8}: {stats["seconds_median"]:8.3f}s {rss} {stats["output_bytes"]:>13,} bytes')
+
+    pathlib.Path(args.output).write_text(json.dumps(results, indent = 2), encoding = "utf-8")
+    print(f"Results saved to {args.output}")
+
+    if args.compare:
+        compare(results, json.loads(pathlib.Path(args.compare).read_text(encoding = "utf-8")))
@@ -0,0 +1,160 @@
+"""
+Regression tests for 03_nb_exporter.py
+
+  How to run:
+       python -m pytest -q MoneyLion/tests
+"""
+
+import base64 # For decoding typed arrays
+import importlib.util # For loading the scripts (their names start with a digit, so they can't be imported normally)
+import json # For writing the synthetic notebook
+import math # For NaN checks
+import pathlib # For handling file system paths
+import re # For finding the scripts in the exported page
+import shutil # For finding node
+import struct # For decoding typed arrays
+import subprocess # For running node --check and the exporter script
+import sys # For the current interpreter
+
+import pytest
+
+SRC_DIR = pathlib.Path(__file__).resolve().parent.parent / "src"
+
+
+def load_script(file_name, module_name):
+    # https://docs.python.org/3/library/importlib.html#importing-a-source-file-directly
+    spec = importlib.util.spec_from_file_location(module_name, SRC_DIR / file_name)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+exporter = load_script("03_nb_exporter.py", "nb_exporter")
+bench = load_script("04_nb_export_bench.py", "nb_export_bench")
+
+
+@pytest.fixture
+def shared_templates_page(tmp_path):
+    # Small synthetic notebook (plotly figures sharing one template) exported with --share-plotly-templates
+    notebook = tmp_path / "synthetic.ipynb"
+    notebook.write_text(json.dumps(bench.generate_notebook(bench.PRESETS["small"])), encoding = "utf-8")
+    html_file = exporter.export_notebook(str(notebook), use_cache = False, share_plotly_templates = True)
+    return pathlib.Path(html_file).read_text(encoding = "utf-8")
+
+def test_shared_templates_after_head(shared_templates_page):
+    # The templates script goes at the start of the real <body>, not into the "<body>" mentioned by the head script
+    head, body = shared_templates_page.split("</head>", 1)
+    assert "window.plotlyTemplates" not in head
+    assert re.search(r"<body\b[^>]*>\s*<script>\s*// ===== Shared Plotly templates", body)
+
+@pytest.mark.skipif(shutil.which("node") is None, reason = "node is not installed")
+def test_head_scripts_parse(shared_templates_page, tmp_path):
+    # Every inline script of the <head> (the injected toggle/collapse script included) is still valid JavaScript
+    head = shared_templates_page.split("</head>", 1)[0]
+    scripts = re.findall(r"<script>(.*?)</script>", head, re.S)
+    assert scripts
+    for number, script in enumerate(scripts):
+        script_file = tmp_path / f"head-{number}.js"
+        script_file.write_text(script, encoding = "utf-8")
+        result = subprocess.run(["node", "--check", str(script_file)], capture_output = True, text = True)
+        assert result.returncode == 0, result.stderr
+
+def test_coalesce_streams_keeps_interleaved_order():
+    # stderr A, stdout B, stderr C stays in that order, only adjacent outputs of one stream are merged
+    nbformat = pytest.importorskip("nbformat")
+    stream = nbformat.v4.new_output
+    cell = nbformat.v4.new_code_cell(outputs = [
+        stream("stream", name = "stderr", text = "Trial 0 finished\n"),
+        stream("stream", name = "stdout", text = "[LightGBM] a\n"),
+        stream("stream", name = "stdout", text = "[LightGBM] b\n"),
+        stream("stream", name = "stderr", text = "Trial 1 finished\n"),
+    ])
+    nb = nbformat.v4.new_notebook(cells = [cell])
+    nb, _ = exporter.coalesce_streams_preprocessor(nb, {"coalesce_streams": True})
+    assert [(output.name, output.text) for output in nb.cells[0].outputs] == [
+        ("stderr", "Trial 0 finished\n"), ("stdout", "[LightGBM] a\n[LightGBM] b\n"), ("stderr", "Trial 1 finished\n")]
+
+def test_write_html_figures_are_parsed():
+    # fig.write_html() writes id before class, the notebook renderer class before id
+    script = ('<script type="text/javascript"> window.PLOTLYENV=window.PLOTLYENV || {}; '
+              'if (document.getElementById("{id}")) { Plotly.newPlot( "{id}", [{"type": "heatmap", "z": [[1, null]]}], {}, {} ) }; </script>')
+    html = ('<div id="a" class="plotly-graph-div" style="height:100%;"></div> ' + script.replace("{id}", "a")
+            + '<div class="plotly-graph-div" id="b" style="height:100%;"></div> ' + script.replace("{id}", "b"))
+    figures = list(exporter.parse_plotly_figures(html))
+    assert [(figure["id"], figure["attrs"]) for _, _, figure in figures] == [("a", ' style="height:100%;"'),
+                                                                            ("b", ' style="height:100%;"')]
+
+def test_typed_array_keeps_missing_values_as_nan():
+    # Masked cells (null) of a correlation matrix become NaN, which plotly.js also draws as gaps
+    matrix = [[None if column < row else 1 / (row + column + 3) for column in range(10)] for row in range(10)]
+    array = exporter.typed_array(matrix, min_length = 1)
+    assert array["dtype"] == "f8" and array["shape"] == "10, 10"
+    values = struct.unpack("<100d", base64.b64decode(array["bdata"]))
+    assert values[:2] == (1 / 3, 1 / 4) and math.isnan(values[10]) and values[11] == 1 / 5
+
+@pytest.mark.parametrize("accept_encoding, expected", [
+    ("gzip, deflate, br", True), ("gzip;q=0", False), ("br, gzip; q=0.0", False), ("gzip;q=0.5", True),
+    ("*", True), ("*;q=0", False), ("identity", False), ("", False), ("*, gzip;q=0", False), ("x-gzip", True),
+])
+def test_accepts_gzip(accept_encoding, expected):
+    assert exporter.accepts_gzip(accept_encoding) is expected
+
+def test_postprocess_site_page_is_idempotent(tmp_path):
+    # A site page keeps its injection in asset files: postprocessing replaces it instead of adding an inline copy
+    notebook = tmp_path / "synthetic.ipynb"
+    notebook.write_text(json.dumps(bench.generate_notebook(bench.PRESETS["small"])), encoding = "utf-8")
+    page = pathlib.Path(exporter.export_notebook(str(notebook), use_cache = False, site_dir = str(tmp_path / "site")))
+    exporter.postprocess_html(page, output = page)
+    once = page.read_text(encoding = "utf-8")
+    exporter.postprocess_html(page, output = page)
+    assert page.read_text(encoding = "utf-8") == once
+    head = once.split("</head>", 1)[0]
+    assert "/* ===== Watermark" not in head
+    assert head.count(exporter.INJECTION_MARKER) == 1 and head.count('<script src="assets/script-') == 1
+
+def test_watch_waits_out_unwatched_events(tmp_path, monkeypatch):
+    # An event for an unwatched file (editor temp file) restarts the quiet period instead of ending it
+    notebook = tmp_path / "nb.ipynb"
+    notebook.write_text("{}", encoding = "utf-8")
+    script = [{notebook}, {tmp_path / ".nb.ipynb.swp"}, set()]
+    calls = []
+
+    def wait(timeout):
+        if not script:
+            raise KeyboardInterrupt
+        calls.append(("wait", timeout))
+        return script.pop(0)
+
+    monkeypatch.setattr(exporter, "inotify_waiter", lambda directories: wait)
+    monkeypatch.setattr(exporter, "warm_exporter", lambda exporter: None)
+    monkeypatch.setattr(exporter, "get_html_exporter", lambda: None)
+    monkeypatch.setattr(exporter, "export_all_notebooks", lambda notebooks, **options: calls.append(("export", notebooks)))
+    exporter.watch_notebooks([str(tmp_path)], debounce = 0.3)
+    assert calls == [("export", [str(notebook)]), ("wait", None), ("wait", 0.3), ("wait", 0.3), ("export", [str(notebook)])]
+
+def test_cache_key_follows_exporter_source(monkeypatch):
+    # Editing the exporter invalidates cached exports without bumping CACHE_FORMAT_VERSION
+    before = exporter.cache_key(b"{}", None, "", {})
+    monkeypatch.setattr(exporter, "exporter_source_digest", lambda: "edited")
+    assert exporter.cache_key(b"{}", None, "", {}) != before
+
+def test_parallel_exports_keep_every_cache_entry(tmp_path):
+    # Workers hand their cache entries to the parent, which writes the manifest once, so none is lost to a race
+    notebook = json.dumps(bench.generate_notebook(bench.PRESETS["small"]))
+    names = [tmp_path / f"nb{number}.ipynb" for number in range(4)]
+    for name in names:
+        name.write_text(notebook, encoding = "utf-8")
+    # Run the script itself: worker processes must be able to import the module of _export_worker
+    result = subprocess.run([sys.executable, str(SRC_DIR / "03_nb_exporter.py"), "--jobs", "2", *map(str, names)],
+                            capture_output = True, text = True)
+    assert result.returncode == 0, result.stderr
+    manifest = json.loads((tmp_path / exporter.CACHE_MANIFEST_NAME).read_text(encoding = "utf-8"))
+    assert sorted(manifest) == [name.name for name in names]
+
+def test_downsample_markers_with_repeated_x():
+    # 1,000 points over 5 distinct x values (a strip plot): binning by x would leave 10 points, by index keeps the spread
+    y = [(i * 7919) % 1000 / 10 for i in range(1000)]
+    trace = {"type": "scatter", "mode": "markers", "x": [i % 5 for i in range(1000)], "y": list(y)}
+    assert exporter.downsample_trace(trace, 100) == 1000
+    assert 90 <= len(trace["y"]) <= 100 and len(trace["x"]) == len(trace["y"])
+    assert min(trace["y"]) == min(y) and max(trace["y"]) == max(y)
+    assert trace["y"][0] == y[0] and trace["y"][-1] == y[-1]